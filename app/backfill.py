@@ -0,0 +1,220 @@
+"""Send historical OwnCloud activity to Traffic Monitor
+
+Records of a JSONL (one webhook payload per line) or CSV (webhook fields
+as columns) export go through the same event creators as /get_hook and
+are delivered with N parallel connections, in order per file.
+
+Progress is checkpointed: a rerun with the same checkpoint file resumes
+after the last record all earlier records of which are done. Records of a
+resumed run delivered before are also recognized by the ledger and not
+sent twice.
+
+Usage:
+    python app/backfill.py activity.jsonl [-c 4] [--rate 50] [--tenant acme]
+"""
+import argparse
+import csv
+import functools
+import json
+import os
+import threading
+import time
+from typing import Iterator, Optional, Set, Tuple
+
+import metrics
+from config import logger, settings
+from delivery import Delivery, DeliveryScheduler
+from filters import accept_webhook
+from ledger import close_ledger, fingerprint
+from pool import get_pools
+from ratelimit import TokenBucket
+from tenants import Tenant, get_tenant
+
+# Поля выгрузки CSV, которые в вебхуке OwnCloud приходят числами
+INTEGER_FIELDS: Tuple[str, ...] = ('datetime', 'timestamp', 'size', 'share_type', 'permissions', 'expiration')
+BOOLEAN_FIELDS: Tuple[str, ...] = ('passwordEnabled',)
+
+
+def _csv_record(row: dict) -> dict:
+    record: dict = {}
+    for name, value in row.items():
+        if value is None or value == '':
+            continue
+        if name in INTEGER_FIELDS and value.lstrip('-').isdigit():
+            record[name] = int(value)
+        elif name in BOOLEAN_FIELDS:
+            record[name] = value.lower() in ('1', 'true', 'yes')
+        else:
+            record[name] = value
+    return record
+
+
+def read_records(path: str, file_format: str) -> Iterator[dict]:
+    """Stream records of the export without loading it into memory"""
+
+    with open(path, encoding='utf-8', newline='') as stream:
+        if file_format == 'csv':
+            for row in csv.DictReader(stream):
+                yield _csv_record(row)
+        else:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as err:
+                    # битая строка не останавливает загрузку, запись без request_type будет пропущена
+                    logger.error(f"Broken JSON line: {err}")
+                    yield {}
+
+
+class Checkpoint:
+    """Number of leading records that are done, saved atomically to a file
+
+    Records complete out of order, so finished numbers above the watermark
+    are kept until the gap below them is closed.
+    """
+
+    def __init__(self, path: str, source: str):
+        self.path: str = path
+        self.source: str = source
+        self.done: int = 0
+        self._finished: Set[int] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as stream:
+                state: dict = json.load(stream)
+            if state.get('source') == source:
+                self.done = state['done']
+
+    def finish(self, number: int) -> None:
+        with self._lock:
+            self._finished.add(number)
+            while self.done in self._finished:
+                self._finished.discard(self.done)
+                self.done += 1
+
+    def save(self) -> None:
+        with self._lock:
+            state: dict = {'source': self.source, 'done': self.done, 'saved_at': time.time()}
+        temporary: str = f'{self.path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as stream:
+            json.dump(state, stream)
+        os.replace(temporary, self.path)
+
+
+class Backfill:
+    def __init__(self, tenant: Tenant, connections: int, rate: float, checkpoint: Checkpoint):
+        # импорт main поднимает Flask-приложение, создатели событий и доставка берутся оттуда же, что и для /get_hook
+        import main
+
+        # все метрики объявлены при импорте main, теперь можно создать их общую область
+        metrics.init(1)
+        self.main = main
+        self.tenant: Tenant = tenant
+        self.checkpoint: Checkpoint = checkpoint
+        self.bucket: Optional[TokenBucket] = TokenBucket(rate, rate) if rate else None
+        self.submitted: int = 0
+        self.delivered: int = 0
+        self.failed: int = 0
+        self.invalid: int = 0
+        self.filtered: int = 0
+        self.started: float = time.monotonic()
+        # записи после контрольной точки могли уйти до остановки, при продолжении их проверяет журнал
+        send = functools.partial(main.deliver, replayed=True) if checkpoint.done else main.deliver
+        self.scheduler = DeliveryScheduler(
+            send, partitions=connections, lanes=settings.DELIVERY_LANES,
+            queue_size=settings.DELIVERY_QUEUE_SIZE, attempts=settings.DELIVERY_ATTEMPTS,
+            retry_delay=settings.DELIVERY_RETRY_DELAY, report=self._report
+        )
+
+    def submit(self, number: int, data: dict) -> None:
+        if data and not accept_webhook(data):
+            self.filtered += 1
+            self.checkpoint.finish(number)
+            return
+        try:
+            creator = self.main._get_event_creator(data)(data)
+            creator.owncloud_host = self.tenant.owncloud_host
+            event = creator.create_event()
+        except (KeyError, TypeError, ValueError) as err:
+            logger.error(f"Record {number} skipped: {err!r}")
+            self.invalid += 1
+            self.checkpoint.finish(number)
+            return
+        webhook: str = fingerprint(self.tenant.name, data)
+        # запись выгрузки - одно получение вебхука, повторный запуск повторяет ту же доставку
+        meta: dict = {
+            'delivery_id': f'{webhook}:{number}', 'fingerprint': webhook, 'tenant': self.tenant.name,
+            'request_type': data['request_type'], 'path': str(creator.file_path), 'owner': creator.owner,
+            'number': number,
+        }
+        if self.bucket is not None:
+            self.bucket.acquire()
+        self.scheduler.submit(self.main._get_delivery_key(creator), event, tenant=self.tenant.name, meta=meta)
+        self.submitted += 1
+
+    def _report(self, delivery: Delivery, guid, error: Optional[Exception]) -> None:
+        # в журнал попадает то же, что и для вебхуков, номер записи нужен только контрольной точке
+        delivery.meta = dict(delivery.meta)
+        number: int = delivery.meta.pop('number')
+        self.main._report_delivery(delivery, guid, error)
+        if error is None:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        self.checkpoint.finish(number)
+
+    def progress(self) -> str:
+        elapsed: float = time.monotonic() - self.started
+        completed: int = self.delivered + self.failed
+        return (
+            f"submitted {self.submitted}, delivered {self.delivered}, failed {self.failed}, "
+            f"invalid {self.invalid}, filtered {self.filtered}, {completed / elapsed if elapsed else 0:.1f} events/s"
+        )
+
+    def close(self) -> None:
+        self.scheduler.close()
+        close_ledger()
+        for pool in get_pools().values():
+            pool.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='JSONL or CSV export of OwnCloud activity')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help='default: by file extension')
+    parser.add_argument('-c', '--connections', type=int, default=4, help='parallel PushAPI connections')
+    parser.add_argument('--rate', type=float, default=20, help='events per second, 0 - unlimited')
+    parser.add_argument('--tenant', help='tenant of the export, default tenant if omitted')
+    parser.add_argument('--checkpoint', help='progress file, default: <source>.checkpoint')
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between progress reports')
+    args = parser.parse_args()
+
+    file_format: str = args.format or ('csv' if args.source.lower().endswith('.csv') else 'jsonl')
+    checkpoint = Checkpoint(args.checkpoint or f'{args.source}.checkpoint', os.path.abspath(args.source))
+    # каждому потоку доставки - своё соединение
+    settings.PUSHAPI_POOL_SIZE = max(settings.PUSHAPI_POOL_SIZE, args.connections)
+    backfill = Backfill(get_tenant(args.tenant), args.connections, args.rate, checkpoint)
+    resume_from: int = checkpoint.done
+    if resume_from:
+        print(f"Resuming after record {resume_from}")
+
+    reported: float = time.monotonic()
+    try:
+        for number, data in enumerate(read_records(args.source, file_format)):
+            if number < resume_from:
+                continue
+            backfill.submit(number, data)
+            if time.monotonic() - reported >= args.report_interval:
+                reported = time.monotonic()
+                checkpoint.save()
+                print(backfill.progress(), flush=True)
+    finally:
+        backfill.close()
+        checkpoint.save()
+    print(backfill.progress())
+
+
+if __name__ == '__main__':
+    main()
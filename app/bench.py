@@ -0,0 +1,220 @@
+"""Micro benchmarks of the delivery hot path
+
+Usage:
+    python app/bench.py encode [-n 2000]
+    python app/bench.py memory [-n 2000]
+    python app/bench.py timestamp [-n 2000]
+    python app/bench.py startup [-n 20]
+    python app/bench.py spool [-n 2000]
+    python app/bench.py filter [-n 2000]
+"""
+import argparse
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from config import BASE_DIR
+from pushapi import EventProcessor, ttypes
+from sender import TrafficMonitor
+
+SAMPLE_WEBHOOK: dict = {
+    'request_type': 'node_shared',
+    'path': '/admin/files/Documents/report.docx',
+    'owner': 'admin',
+    'node_type': 'file',
+    'share_type': 3,
+    'share_with': 'user1',
+    'public_link_path': '/s/AbCdEf',
+    'permissions': 1,
+    'expiration': 1700000000,
+}
+
+
+def _offline_monitor() -> TrafficMonitor:
+    """TrafficMonitor without server connection: only event building is measured"""
+
+    monitor = object.__new__(TrafficMonitor)
+    monitor._creds = ttypes.Credentials('company', 'token')
+    return monitor
+
+
+def _measure(name: str, func: Callable, count: int) -> None:
+    for _ in range(min(count, 100)):
+        func()
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - started
+
+    peak_total = 0
+    for _ in range(100):
+        tracemalloc.start()
+        func()
+        peak_total += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print(f'{name:<24} {elapsed / count * 1e6:10.1f} us/event {peak_total / 100:10.0f} peak bytes/event')
+
+
+def bench_encode(count: int) -> None:
+    """Thrift objects + BeginEvent_args.write() versus direct encoder"""
+
+    from main import _get_event
+
+    monitor = _offline_monitor()
+    event = _get_event(SAMPLE_WEBHOOK)
+
+    def objects():
+        evt = monitor.make_event(event)
+        buffer = TTransport.TMemoryBuffer()
+        EventProcessor.BeginEvent_args(evt, monitor._creds).write(TBinaryProtocol.TBinaryProtocol(buffer))
+        return buffer.getvalue()
+
+    def direct():
+        return monitor.encode_event(event).payload
+
+    _measure('thrift objects', objects, count)
+    _measure('direct encoder', direct, count)
+
+
+def bench_memory(count: int) -> None:
+    """Memory held by queued event descriptions"""
+
+    from main import _get_event
+
+    tracemalloc.start()
+    before: int = tracemalloc.get_traced_memory()[0]
+    events: list = [_get_event(dict(SAMPLE_WEBHOOK, path=f'/admin/files/{number}.docx')) for number in range(count)]
+    after: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{len(events)} events: {(after - before) / count:10.0f} bytes/event')
+
+
+def bench_timestamp(count: int) -> None:
+    """Capture time and webhook timestamp formatting, uncached versus cached"""
+
+    from datetime import datetime
+
+    from dateutil.tz import tzlocal
+
+    from event_creator import EventCreatorWithMessage
+    from pushapi import pushapi_wrappers as wrappers
+
+    _measure('now: uncached', lambda: datetime.now(tzlocal()).replace(microsecond=0).isoformat(), count)
+    _measure('now: cached', wrappers.get_current_datetime_tz, count)
+    _measure('fromtimestamp: uncached', lambda: str(datetime.fromtimestamp(1700000000)), count)
+    _measure('fromtimestamp: cached', lambda: EventCreatorWithMessage._get_from_timestamp(1700000000), count)
+
+
+def bench_startup(count: int) -> None:
+    """Cold start of the bridge process: -X importtime report and wall time of 'import main'"""
+
+    command: list = [sys.executable, '-X', 'importtime', '-c', 'import main']
+    result = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    modules: list = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative_us), int(self_us), name.rstrip()))
+    print(f'{"cumulative us":>14} {"self us":>10}  module')
+    for cumulative_us, self_us, name in sorted(modules, reverse=True)[:25]:
+        print(f'{cumulative_us:14} {self_us:10}  {name}')
+
+    elapsed: list = []
+    for _ in range(min(count, 20)):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=BASE_DIR, check=True)
+        elapsed.append(time.perf_counter() - started)
+    print(f'\nimport main: best {min(elapsed) * 1000:.1f} ms of {len(elapsed)} runs')
+
+
+def _thrift_to_json(value):
+    if isinstance(value, list):
+        return [_thrift_to_json(item) for item in value]
+    if hasattr(value, 'thrift_spec'):
+        return {name: _thrift_to_json(item) for name, item in value.__dict__.items() if item is not None}
+    return value
+
+
+def bench_spool(count: int) -> None:
+    """Spool record of an event: Thrift compact protocol versus JSON (decoded to dicts only)"""
+
+    import json
+
+    from main import _get_event
+    from spool import decode_event, encode_event
+
+    monitor = _offline_monitor()
+    evt = monitor.make_event(_get_event(SAMPLE_WEBHOOK))
+    compact: bytes = encode_event(evt)
+    text: bytes = json.dumps(_thrift_to_json(evt), ensure_ascii=False).encode('utf-8')
+    print(f'{"compact":<24} {len(compact):10} bytes/event')
+    print(f'{"json":<24} {len(text):10} bytes/event')
+    _measure('compact: encode', lambda: encode_event(evt), count)
+    _measure('json: encode', lambda: json.dumps(_thrift_to_json(evt), ensure_ascii=False).encode('utf-8'), count)
+    _measure('compact: decode', lambda: decode_event(compact), count)
+    _measure('json: decode', lambda: json.loads(text), count)
+
+
+def bench_filter(count: int) -> None:
+    """Filter of 60 rules: compiled trie and regex versus checking path globs rule by rule"""
+
+    import re
+
+    from filters import WebhookFilter, glob_to_regex
+
+    rules: list = []
+    for number in range(20):
+        rules.append({'action': 'exclude', 'paths': [f'/user{number}/files_trashbin/**', f'/user{number}/cache/']})
+        rules.append({'action': 'exclude', 'paths': [f'**/*.tmp{number}', f'/*/thumbnails{number}/**']})
+        rules.append({'action': 'include', 'owners': [f'user{number}'], 'request_types': ['node_shared']})
+    config: dict = {'default': 'include', 'rules': rules}
+    compiled = WebhookFilter(config)
+    # тот же набор правил без компиляции: каждый шаблон пути проверяется своим регулярным выражением
+    naive: list = [
+        [re.compile(glob_to_regex(glob) + r'\Z') for glob in rule.get('paths', ())] for rule in rules
+    ]
+
+    def rule_by_rule(data: dict) -> bool:
+        for rule, patterns in zip(rules, naive):
+            if 'owners' in rule and data['owner'] not in rule['owners']:
+                continue
+            if 'request_types' in rule and data['request_type'] not in rule['request_types']:
+                continue
+            if patterns and not any(pattern.match(data['path']) for pattern in patterns):
+                continue
+            return rule['action'] == 'include'
+        return True
+
+    dropped: dict = dict(SAMPLE_WEBHOOK, path='/admin/files/Documents/~report.tmp19')
+    for name, data in (('dropped', dropped), ('passed', SAMPLE_WEBHOOK)):
+        assert compiled.accept(data) == rule_by_rule(data)
+        _measure(f'compiled: {name}', lambda: compiled.accept(data), count)
+        _measure(f'rule by rule: {name}', lambda: rule_by_rule(data), count)
+
+
+BENCHMARKS: dict = {
+    'encode': bench_encode,
+    'memory': bench_memory,
+    'timestamp': bench_timestamp,
+    'startup': bench_startup,
+    'spool': bench_spool,
+    'filter': bench_filter,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from config import settings
+from digest import WindowAggregator
+from event_creator import ChatMessage, EventDescription, NodeShareEvent
+
+COALESCED = metrics.counter('shares_coalesced_total', 'Share webhooks merged into an event of another recipient')
+
+# Публичные ссылки (share_type 3) без получателя и идут в приоритетной полосе, они не объединяются
+COALESCED_SHARE_TYPES: Tuple[str, ...] = ('0', '1', '4')
+
+
+class ShareState:
+    __slots__ = ('event', 'delivery_key', 'lane', 'receivers', 'text', 'permissions', 'metas')
+
+    def __init__(self, event: EventDescription, delivery_key: str, lane: Optional[str], permissions: str):
+        self.event: EventDescription = event
+        self.delivery_key: str = delivery_key
+        self.lane: Optional[str] = lane
+        # упорядоченное множество получателей
+        self.receivers: Dict[str, None] = dict.fromkeys(event.receivers)
+        self.text: List[str] = [event.messages[0].text] if event.messages else []
+        self.permissions: str = permissions
+        self.metas: List[dict] = []
+
+
+class ShareCoalescer(WindowAggregator):
+    """One event for shares of a path by its owner to many recipients
+
+    OwnCloud sends a node_shared webhook per recipient of a folder shared
+    with several users or a group. Shares of the same path by the same
+    owner within the window are sent as the first event with all recipients
+    in evt_receivers and a share line per recipient added to its message.
+    Another event of the same delivery key must not overtake the merged one,
+    so flush() sends open windows of the key, and waits for those being sent
+    by the flush thread, before it is submitted.
+    """
+
+    def __init__(self, window: float, max_paths: int, max_receivers: int, send: Callable):
+        self.max_receivers: int = max_receivers
+        self.send = send
+        # открытые окна по (арендатор, ключ доставки) в порядке открытия
+        self._keys: Dict[Tuple[str, str], Dict[Tuple[str, str, str], None]] = {}
+        super().__init__('coalesce-shares', window, max_paths)
+
+    @staticmethod
+    def accepts(data: dict) -> bool:
+        return data.get('request_type') == 'node_shared' and str(data.get('share_type')) in COALESCED_SHARE_TYPES
+
+    def add_share(
+            self,
+            tenant: str,
+            creator: NodeShareEvent,
+            event: EventDescription,
+            meta: Optional[dict],
+            delivery_key: str,
+            lane: Optional[str]
+    ) -> None:
+        self.add((tenant, creator.owner, str(creator.file_path)), (creator, event, meta, delivery_key, lane))
+
+    def flush(self, tenant: str, delivery_key: str) -> None:
+        """Send open windows of the delivery key at once"""
+
+        with self._lock:
+            keys: list = list(self._keys.get((tenant, delivery_key), ()))
+        for key in keys:
+            self.flush_window(key)
+
+    def open_window(self, key: Tuple[str, str, str], item: tuple) -> ShareState:
+        creator, event, meta, delivery_key, lane = item
+        state = ShareState(event, delivery_key, lane, creator.permissions)
+        state.metas.append(meta)
+        # окно открывается под блокировкой агрегатора
+        self._keys.setdefault((key[0], delivery_key), {})[key] = None
+        return state
+
+    def merge(self, state: ShareState, item: tuple) -> bool:
+        creator, event, meta, _, _ = item
+        state.metas.append(meta)
+        COALESCED.inc()
+        for receiver in event.receivers:
+            if receiver in state.receivers:
+                continue
+            state.receivers[receiver] = None
+            line: str = creator._get_share_type()
+            # права у получателей могут различаться, тогда они указываются для каждого
+            if creator.permissions != state.permissions:
+                line += f'Модификатор доступа: {creator.permissions}\n'
+            state.text.append(line)
+        return len(state.receivers) >= self.max_receivers
+
+    def close_window(self, key: Tuple[str, str, str], state: ShareState) -> None:
+        tenant, _, _ = key
+        event: EventDescription = state.event
+        if len(state.metas) > 1:
+            event = event._replace(
+                receivers=tuple(state.receivers),
+                messages=(ChatMessage(text=''.join(state.text)),) if state.text else event.messages,
+            )
+        try:
+            self.send(tenant, state.delivery_key, state.lane, event, state.metas)
+        finally:
+            # окно остаётся в индексе, пока событие не передано, чтобы flush() дождался его
+            with self._lock:
+                keys: Optional[dict] = self._keys.get((tenant, state.delivery_key))
+                if keys is not None and key not in self._windows and self._closing[key] == 1:
+                    keys.pop(key, None)
+                    if not keys:
+                        del self._keys[(tenant, state.delivery_key)]
+
+
+_coalescer: Optional[ShareCoalescer] = None
+_coalescer_lock = threading.Lock()
+
+
+def get_share_coalescer(send: Callable) -> Optional[ShareCoalescer]:
+    """Return share coalescer of the process or None when shares are sent one by one
+
+    send(tenant, delivery_key, lane, event, metas) delivers a merged event, metas are
+    ledger details of its webhooks, the first one is the webhook the event was created for.
+    """
+
+    global _coalescer
+    if not settings.SHARE_COALESCE_WINDOW:
+        return None
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = ShareCoalescer(
+                settings.SHARE_COALESCE_WINDOW, settings.SHARE_COALESCE_MAX_PATHS,
+                settings.SHARE_COALESCE_MAX_RECEIVERS, send
+            )
+    return _coalescer
+
+
+def close_share_coalescer() -> None:
+    """Send events of all open windows"""
+
+    global _coalescer
+    with _coalescer_lock:
+        coalescer, _coalescer = _coalescer, None
+    if coalescer is not None:
+        coalescer.close()
+
+
+def _forget_coalescer() -> None:
+    """Flush thread is not inherited by a forked worker, it starts its own coalescer"""
+
+    global _coalescer
+    _coalescer = None
+
+
+os.register_at_fork(after_in_child=_forget_coalescer)
@@ -1,8 +1,24 @@
+import hashlib
 import logging.config
 import sys
 from pathlib import Path
+from typing import Dict, Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings, Extra, validator
+
+
+class TenantSettings(BaseModel):
+    """Options of a tenant in TENANTS, unknown options are rejected"""
+
+    company_name: str
+    token: str
+    owncloud_host: str
+    host: Optional[str] = None
+    port: Optional[int] = None
+    weight: int = 1
+
+    class Config:
+        extra = Extra.forbid
 
 
 class Settings(BaseSettings):
@@ -11,9 +27,80 @@ class Settings(BaseSettings):
     NAME_DFL: str
     TOKEN_DFL: str
     OWNCLOUD_HOST: str
+    OWNCLOUD_USER: str = ''
+    OWNCLOUD_PASSWORD: str = ''
+    OWNCLOUD_WEBDAV_PATH: str = '/remote.php/webdav'
+    FILE_SOURCE: str = 'local'
+    STREAM_CHUNK_SIZE: int = 1024 * 1024
+    STREAM_READ_AHEAD: int = 2
+    CHAT_INLINE_LIMIT: int = 64 * 1024
+    STREAM_DIGESTS: str = 'sha256'
+    DIRECT_ENCODING: bool = True
+    PUSHAPI_POOL_SIZE: int = 4
+    PUSHAPI_IDLE_TIMEOUT: int = 300
+    WARMUP_CONNECTIONS: int = 0
+    WARMUP_TIMEOUT: int = 30
+    WARMUP_RETRY_INTERVAL: float = 5
+    HTTP_POOL_SIZE: int = 10
+    HTTP_TIMEOUT: int = 30
     DEBUG: bool = False
     APP_HOST: str = "127.0.0.1"
     APP_PORT: int = 8989
+    SERVER_MODE: str = 'dev'
+    WORKERS: int = 0
+    REUSE_PORT: bool = False
+    DELIVERY_WORKERS: int = 0
+    DELIVERY_KEY: str = 'path'
+    DELIVERY_QUEUE_SIZE: int = 1000
+    DELIVERY_LANES: Dict[str, int] = {'high': 8, 'normal': 4, 'low': 1}
+    DELIVERY_LANE_RULES: Dict[str, str] = {
+        'node_shared:3': 'high',
+        'node_share_permission_updated:3': 'high',
+        'node_shared': 'normal',
+        'node_share_permission_updated': 'normal',
+        'node_created': 'normal',
+        'node_downloaded': 'low',
+    }
+    DELIVERY_MAX_WAIT: float = 5
+    TENANT_DEFAULT: str = 'default'
+    TENANTS: Dict[str, TenantSettings] = {}
+    TENANT_HEADER: str = 'X-Tenant'
+    TENANT_FIELD: str = 'tenant'
+    RATE_LIMIT_EVENTS: float = 0
+    RATE_LIMIT_BYTES: float = 0
+    RATE_LIMIT_BURST: float = 1.0
+    LEDGER_ENABLED: bool = False
+    LEDGER_PATH: str = ''
+    LEDGER_BATCH_SIZE: int = 500
+    LEDGER_FLUSH_INTERVAL: float = 0.5
+    LEDGER_GUID_CACHE_SIZE: int = 10000
+    DELIVERY_ATTEMPTS: int = 3
+    DELIVERY_RETRY_DELAY: float = 1.0
+    DELIVERY_SHUTDOWN_TIMEOUT: float = 30
+    SPOOL_ENABLED: bool = False
+    SPOOL_DIR: str = ''
+    SPOOL_SEGMENT_SIZE: int = 64 * 1024 * 1024
+    SPOOL_DRAIN_RATE: float = 20
+    SPOOL_PROBE_INTERVAL: float = 5
+    FILTER_RULES_FILE: str = ''
+    DIGEST_REQUEST_TYPES: Dict[str, float] = {}
+    DIGEST_MAX_OWNERS: int = 10000
+    DIGEST_MAX_FILES: int = 1000
+    SHARE_COALESCE_WINDOW: float = 0
+    SHARE_COALESCE_MAX_PATHS: int = 10000
+    SHARE_COALESCE_MAX_RECEIVERS: int = 500
+
+    @validator('STREAM_DIGESTS')
+    def check_stream_digests(cls, value: str) -> str:
+        """Unknown algorithm fails the start, not every file delivery"""
+
+        for name in value.split(','):
+            if name.strip():
+                try:
+                    hashlib.new(name.strip())
+                except ValueError:
+                    raise ValueError(f"unknown hashlib algorithm [{name.strip()}]")
+        return value
 
 
 BASE_DIR = Path(__file__).parent
@@ -47,7 +134,7 @@ logger_conf = {
             "backupCount": 2,
             "maxBytes": 5 * 1024 * 1024,
             "encoding": "utf-8",
-            "delay": False,
+            "delay": True,
             "level": log_level,
             "formatter": "base",
             "filename": str(logs_dir_full_path / 'all.log'),
@@ -58,7 +145,8 @@ logger_conf = {
             "level": 'ERROR',
             "formatter": "base",
             "filename": f"{logs_dir_full_path}/errors.log",
-            "mode": "a"
+            "mode": "a",
+            "delay": True
         }
     },
     "loggers": {
@@ -0,0 +1,436 @@
+import itertools
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import metrics
+from config import logger, settings
+from tenants import get_tenants
+
+RETRIES = metrics.counter('delivery_retries_total', 'Repeated delivery attempts')
+DROPPED = metrics.counter('delivery_dropped_total', 'Events dropped after all delivery attempts')
+
+# Events with the same key (file path or owner) go to the same partition and
+# are delivered one by one in arrival order, different keys are delivered
+# concurrently by partition threads. Within a partition urgent lanes
+# (public links, shares) are served ahead of routine ones. A failed event is retried before the
+# next one of its partition, so retries do not reorder a key.
+
+
+def _lane_depth(lane: str) -> metrics.Gauge:
+    return metrics.gauge('delivery_queue_depth', 'Events waiting for delivery', lane=lane)
+
+
+def _lane_wait(lane: str) -> metrics.Histogram:
+    return metrics.histogram('delivery_queue_wait_seconds', 'Time from webhook to delivery start', lane=lane)
+
+
+# метрики должны быть объявлены до создания общей области, поэтому полосы из настроек регистрируются при импорте
+for _lane in settings.DELIVERY_LANES:
+    _lane_depth(_lane)
+    _lane_wait(_lane)
+
+
+class Delivery:
+    """Event waiting in a partition queue"""
+
+    __slots__ = ('key', 'event', 'lane', 'tenant', 'meta', 'attempts', 'enqueued_at')
+
+    def __init__(self, key: str, event, lane: int = 0, tenant: Optional[str] = None, meta: Optional[dict] = None):
+        self.key: str = key
+        self.event = event
+        self.lane: int = lane
+        self.tenant: Optional[str] = tenant
+        self.meta: Optional[dict] = meta
+        self.attempts: int = 0
+        self.enqueued_at: float = time.monotonic()
+
+
+class LaneQueue:
+    """Partition queue with priority lanes and FIFO order of events of one key
+
+    Every key has its own FIFO of events, lanes hold keys. A key is placed in
+    the highest lane among its pending events, so an urgent event pulls older
+    events of its key along instead of overtaking them. When a key is promoted
+    its entry in the lower lane is left in place and skipped when reached.
+
+    Lanes are served by smooth weighted round robin. A lane whose oldest key
+    waits longer than max_wait is served first, so low lanes do not starve.
+    The queue has a single consumer, the partition thread. TenantQueue passes
+    its own lock and not_empty condition to wait on queues of all tenants.
+    """
+
+    def __init__(
+            self,
+            lanes: Dict[str, int],
+            maxsize: int = 0,
+            max_wait: float = 0,
+            lock: Optional[threading.Lock] = None,
+            not_empty: Optional[threading.Condition] = None
+    ):
+        self.names: List[str] = list(lanes)
+        self.weights: List[int] = [max(weight, 1) for weight in lanes.values()]
+        self.maxsize: int = maxsize
+        self.max_wait: float = max_wait
+        # элементы полос: (ключ, метка размещения, время постановки в полосу)
+        self._lanes: List[Deque[Tuple[str, int, float]]] = [deque() for _ in self.names]
+        self._current: List[int] = [0] * len(self.names)
+        self._depths: List[int] = [0] * len(self.names)
+        self._keys: Dict[str, Deque[Delivery]] = {}
+        self._placed: Dict[str, Tuple[int, int]] = {}
+        self._tokens = itertools.count()
+        self._size: int = 0
+        self._closed: bool = False
+        self._lock = lock or threading.Lock()
+        self._not_empty = not_empty or threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def lane(self, name: Optional[str]) -> int:
+        """Return lane number by name, unknown names go to the lowest lane"""
+
+        return self.names.index(name) if name in self.names else len(self.names) - 1
+
+    def put(self, delivery: Delivery, timeout: Optional[float] = None) -> None:
+        with self._not_full:
+            deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+            while self.maxsize and self._size >= self.maxsize:
+                remaining: Optional[float] = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self._not_full.wait(remaining)
+            pending: Deque[Delivery] = self._keys.setdefault(delivery.key, deque())
+            pending.append(delivery)
+            self._size += 1
+            self._depths[delivery.lane] += 1
+            placed: Optional[Tuple[int, int]] = self._placed.get(delivery.key)
+            if placed is None or delivery.lane < placed[0]:
+                self._place(delivery.key, delivery.lane)
+            self._not_empty.notify()
+
+    def get(self) -> Optional[Delivery]:
+        """Return next event, None when the queue is closed and drained"""
+
+        with self._not_empty:
+            while not self._size:
+                if self._closed:
+                    return None
+                self._not_empty.wait()
+            return self._pop()
+
+    def _pop(self) -> Delivery:
+        """Take next event, the lock must be held and the queue must not be empty"""
+
+        key, _, _ = self._lanes[self._choose()].popleft()
+        del self._placed[key]
+        pending: Deque[Delivery] = self._keys[key]
+        delivery: Delivery = pending.popleft()
+        if pending:
+            self._place(key, min(item.lane for item in pending))
+        else:
+            del self._keys[key]
+        self._size -= 1
+        self._depths[delivery.lane] -= 1
+        self._not_full.notify()
+        return delivery
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+
+    def _place(self, key: str, lane: int) -> None:
+        token: int = next(self._tokens)
+        self._placed[key] = (lane, token)
+        self._lanes[lane].append((key, token, time.monotonic()))
+
+    def _choose(self) -> int:
+        active: List[int] = []
+        for number, entries in enumerate(self._lanes):
+            # устаревшие элементы (ключ повышен в другую полосу или уже выбран) удаляются из головы полосы
+            while entries and self._placed.get(entries[0][0]) != (number, entries[0][1]):
+                entries.popleft()
+            if entries:
+                active.append(number)
+        if self.max_wait:
+            oldest: int = min(active, key=lambda number: self._lanes[number][0][2])
+            if time.monotonic() - self._lanes[oldest][0][2] >= self.max_wait:
+                return oldest
+        total: int = 0
+        best: int = active[0]
+        for number in active:
+            self._current[number] += self.weights[number]
+            total += self.weights[number]
+            if self._current[number] > self._current[best]:
+                best = number
+        self._current[best] -= total
+        return best
+
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return bool(self.maxsize) and self._size >= self.maxsize
+
+    def depths(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(zip(self.names, self._depths))
+
+
+class TenantQueue:
+    """Partition queue with a LaneQueue per tenant served by deficit round robin
+
+    Every visit adds the tenant weight to its deficit, one event costs one
+    unit. A tenant is served while its deficit lasts and then moves to the
+    end of the round. Queue size is limited per tenant, so webhooks of a
+    noisy tenant wait for its own queue and do not block other tenants.
+    """
+
+    def __init__(self, lanes: Dict[str, int], maxsize: int = 0, max_wait: float = 0,
+                 weights: Optional[Dict[str, int]] = None):
+        self.lanes: Dict[str, int] = lanes
+        self.maxsize: int = maxsize
+        self.max_wait: float = max_wait
+        self.weights: Dict[str, int] = weights or {}
+        self._tenants: Dict[Optional[str], LaneQueue] = {}
+        self._active: Deque[Optional[str]] = deque()
+        self._deficit: Dict[Optional[str], int] = {}
+        self._closed: bool = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def lane(self, name: Optional[str]) -> int:
+        """Return lane number by name, it is the same in queues of all tenants"""
+
+        names: List[str] = list(self.lanes)
+        return names.index(name) if name in names else len(names) - 1
+
+    def _queue(self, tenant: Optional[str]) -> LaneQueue:
+        with self._lock:
+            if tenant not in self._tenants:
+                self._tenants[tenant] = LaneQueue(
+                    self.lanes, self.maxsize, self.max_wait, self._lock, self._not_empty
+                )
+            return self._tenants[tenant]
+
+    def put(self, delivery: Delivery, timeout: Optional[float] = None) -> None:
+        self._queue(delivery.tenant).put(delivery, timeout)
+        with self._lock:
+            if delivery.tenant not in self._deficit:
+                self._deficit[delivery.tenant] = 0
+                self._active.append(delivery.tenant)
+                self._not_empty.notify()
+
+    def get(self) -> Optional[Delivery]:
+        """Return next event, None when the queue is closed and drained"""
+
+        with self._not_empty:
+            while True:
+                # опустевший арендатор выходит из круга и не копит дефицит
+                while self._active and not self._tenants[self._active[0]].qsize():
+                    del self._deficit[self._active.popleft()]
+                if self._active:
+                    break
+                if self._closed:
+                    return None
+                self._not_empty.wait()
+            tenant: Optional[str] = self._active[0]
+            if self._deficit[tenant] < 1:
+                self._deficit[tenant] += self.weights.get(tenant, 1)
+            self._deficit[tenant] -= 1
+            if self._deficit[tenant] < 1:
+                self._active.rotate(-1)
+            return self._tenants[tenant]._pop()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+
+    def qsize(self) -> int:
+        with self._lock:
+            return sum(lanes.qsize() for lanes in self._tenants.values())
+
+    def full(self) -> bool:
+        with self._lock:
+            return any(lanes.full() for lanes in self._tenants.values())
+
+    def depths(self) -> Dict[str, int]:
+        depths: Dict[str, int] = dict.fromkeys(self.lanes, 0)
+        with self._lock:
+            for lanes in self._tenants.values():
+                for number, name in enumerate(lanes.names):
+                    depths[name] += lanes._depths[number]
+        return depths
+
+    def tenant_depths(self) -> Dict[Optional[str], int]:
+        with self._lock:
+            return {tenant: lanes.qsize() for tenant, lanes in self._tenants.items()}
+
+
+class DeliveryScheduler:
+    """Deliver events with per-key ordering and parallelism across keys"""
+
+    def __init__(
+            self,
+            send: Callable,
+            partitions: int,
+            lanes: Dict[str, int],
+            queue_size: int = 1000,
+            max_wait: float = 0,
+            attempts: int = 3,
+            retry_delay: float = 1.0,
+            weights: Optional[Dict[str, int]] = None,
+            report: Optional[Callable] = None
+    ):
+        self.send = send
+        self.report = report
+        self.lanes: List[str] = list(lanes)
+        self.attempts: int = max(attempts, 1)
+        self.retry_delay: float = retry_delay
+        self._depth: List[metrics.Gauge] = [_lane_depth(lane) for lane in self.lanes]
+        self._wait: List[metrics.Histogram] = [_lane_wait(lane) for lane in self.lanes]
+        self._queues: List[TenantQueue] = [
+            TenantQueue(lanes, queue_size, max_wait, weights) for _ in range(partitions)
+        ]
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._run, args=(number,), name=f'delivery-{number}', daemon=True)
+            for number in range(partitions)
+        ]
+        self._stopping = threading.Event()
+        for thread in self._threads:
+            thread.start()
+
+    def partition(self, key: str) -> int:
+        # crc32 does not depend on PYTHONHASHSEED, a key maps to the same partition in every worker
+        return zlib.crc32(key.encode('utf-8')) % len(self._queues)
+
+    def submit(
+            self,
+            key: str,
+            event,
+            lane: Optional[str] = None,
+            tenant: Optional[str] = None,
+            meta: Optional[dict] = None,
+            timeout: Optional[float] = None
+    ) -> None:
+        """Put event into the queue of its key, block while the queue of the tenant is full"""
+
+        if self._stopping.is_set():
+            raise RuntimeError("Delivery scheduler is stopped")
+        partition: TenantQueue = self._queues[self.partition(key)]
+        delivery = Delivery(key, event, partition.lane(lane), tenant, meta)
+        partition.put(delivery, timeout=timeout)
+        self._depth[delivery.lane].inc()
+
+    def _run(self, number: int) -> None:
+        partition: TenantQueue = self._queues[number]
+        while True:
+            delivery: Optional[Delivery] = partition.get()
+            if delivery is None:
+                break
+            self._depth[delivery.lane].dec()
+            self._wait[delivery.lane].observe(time.monotonic() - delivery.enqueued_at)
+            self._deliver(delivery)
+
+    def _deliver(self, delivery: Delivery) -> None:
+        while True:
+            delivery.attempts += 1
+            try:
+                guid = self.send(delivery.event, delivery.tenant, delivery.meta)
+            except Exception as err:
+                if delivery.attempts >= self.attempts:
+                    DROPPED.inc()
+                    logger.error(f"Event [{delivery.key}] dropped after {delivery.attempts} attempts: {err}")
+                    self._report(delivery, None, err)
+                    return
+                RETRIES.inc()
+                logger.warning(f"Event [{delivery.key}] attempt {delivery.attempts} failed: {err}")
+            else:
+                self._report(delivery, guid, None)
+                return
+            # при остановке пауза прерывается, оставшиеся попытки идут сразу
+            self._stopping.wait(self.retry_delay * delivery.attempts)
+
+    def _report(self, delivery: Delivery, guid, error: Optional[Exception]) -> None:
+        if self.report is None:
+            return
+        try:
+            self.report(delivery, guid, error)
+        except Exception as err:
+            logger.exception(f"Reporting delivery of [{delivery.key}] failed: {err}")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Deliver queued events and stop partition threads"""
+
+        self._stopping.set()
+        for partition in self._queues:
+            partition.close()
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def health(self) -> dict:
+        depths: list = [partition.qsize() for partition in self._queues]
+        lanes: dict = dict.fromkeys(self.lanes, 0)
+        tenants: dict = {}
+        for partition in self._queues:
+            for lane, depth in partition.depths().items():
+                lanes[lane] += depth
+            for tenant, depth in partition.tenant_depths().items():
+                tenants[tenant] = tenants.get(tenant, 0) + depth
+        alive: bool = all(thread.is_alive() for thread in self._threads) or self._stopping.is_set()
+        return {
+            'alive': alive,
+            # очередь заполнена - вебхуки будут ждать, новые лучше направить на другой экземпляр
+            'ready': alive and all(not partition.full() for partition in self._queues),
+            'partitions': len(self._queues),
+            'queued': sum(depths),
+            'max_partition_depth': max(depths, default=0),
+            'lanes': lanes,
+            'tenants': tenants,
+        }
+
+
+_scheduler: Optional[DeliveryScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(send: Callable, report: Optional[Callable] = None) -> DeliveryScheduler:
+    """Return delivery scheduler of the process, its threads are started on first use
+
+    send(event, tenant, meta) returns guid of the delivered event, report(delivery, guid, error)
+    is called once the event is delivered or dropped.
+    """
+
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = DeliveryScheduler(
+                send, partitions=settings.DELIVERY_WORKERS, lanes=settings.DELIVERY_LANES,
+                queue_size=settings.DELIVERY_QUEUE_SIZE, max_wait=settings.DELIVERY_MAX_WAIT,
+                attempts=settings.DELIVERY_ATTEMPTS, retry_delay=settings.DELIVERY_RETRY_DELAY,
+                weights={name: tenant.weight for name, tenant in get_tenants().items()}, report=report
+            )
+    return _scheduler
+
+
+def close_scheduler(timeout: Optional[float] = None) -> None:
+    global _scheduler
+    with _scheduler_lock:
+        scheduler, _scheduler = _scheduler, None
+    if scheduler is not None:
+        scheduler.close(timeout)
+
+
+def _forget_scheduler() -> None:
+    """Threads are not inherited by a forked worker, it starts its own scheduler"""
+
+    global _scheduler
+    _scheduler = None
+
+
+os.register_at_fork(after_in_child=_forget_scheduler)
@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import metrics
+import pushapi.ttypes
+from config import logger, settings
+from event_creator import ChatMessage, EventCreator, EventDescription
+
+DIGESTED = metrics.counter('webhooks_digested_total', 'Webhooks aggregated into digest events')
+
+# Сколько файлов перечисляется в тексте сводки
+LISTED_FILES: int = 20
+
+
+class WindowAggregator(ABC):
+    """Merge items of the same key that arrive within a window
+
+    A window opens with the first item of its key and closes window seconds
+    later, or at once when merge() reports it is full, then close_window()
+    gets the merged state. Windows are kept in order of opening, so expired
+    ones are found at the front. When there are max_keys open windows the
+    oldest is closed early, so memory stays bounded. close() closes all
+    open windows. A window taken for closing stays in flight until
+    close_window() returns, flush_window() of its key waits for it.
+    """
+
+    def __init__(self, name: str, window: float, max_keys: int):
+        self.window: float = window
+        self.max_keys: int = max(max_keys, 1)
+        self._windows: OrderedDict = OrderedDict()
+        # окна, уже изъятые из _windows, но ещё не отправленные close_window(): число по ключу
+        self._closing: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @abstractmethod
+    def open_window(self, key: Hashable, item):
+        """Return state of a new window for the first item"""
+
+    @abstractmethod
+    def merge(self, state, item) -> bool:
+        """Add item to the window state, return True if the window must be closed now"""
+
+    @abstractmethod
+    def close_window(self, key: Hashable, state) -> None:
+        """Send the merged state of a closed window"""
+
+    def add(self, key: Hashable, item) -> None:
+        closed: Optional[Tuple[Hashable, object]] = None
+        with self._lock:
+            entry: Optional[list] = self._windows.get(key)
+            if entry is not None:
+                if not self.merge(entry[1], item):
+                    return
+                closed = (key, self._take(key))
+            else:
+                if len(self._windows) >= self.max_keys:
+                    oldest: Hashable = next(iter(self._windows))
+                    closed = (oldest, self._take(oldest))
+                self._windows[key] = [time.monotonic() + self.window, self.open_window(key, item)]
+        if closed is not None:
+            self._close(*closed)
+
+    def flush_window(self, key: Hashable) -> None:
+        """Close the window of the key now if it is open, return once it and earlier ones of the key are sent"""
+
+        with self._closed:
+            while key in self._closing:
+                self._closed.wait()
+            state = self._take(key) if key in self._windows else None
+        if state is not None:
+            self._close(key, state)
+
+    def _take(self, key: Hashable):
+        """Remove the window from open ones and mark it in flight, called under the lock"""
+
+        self._closing[key] = self._closing.get(key, 0) + 1
+        return self._windows.pop(key)[1]
+
+    def _close(self, key: Hashable, state) -> None:
+        try:
+            self.close_window(key, state)
+        except Exception as err:
+            logger.exception(f"Closing window [{key}] failed: {err}")
+        finally:
+            with self._closed:
+                if self._closing[key] > 1:
+                    self._closing[key] -= 1
+                else:
+                    del self._closing[key]
+                self._closed.notify_all()
+
+    def _expired(self, now: float) -> List[Tuple[Hashable, object]]:
+        expired: list = []
+        with self._lock:
+            while self._windows:
+                key, (closes_at, _) = next(iter(self._windows.items()))
+                if closes_at > now:
+                    break
+                expired.append((key, self._take(key)))
+        return expired
+
+    def _run(self) -> None:
+        # окно закрывается не позже чем через четверть своей длины (но не более секунды) после срока
+        while not self._stopping.wait(min(self.window / 4, 1)):
+            for key, state in self._expired(time.monotonic()):
+                self._close(key, state)
+
+    def close(self) -> None:
+        """Stop the thread and close all open windows"""
+
+        self._stopping.set()
+        self._thread.join()
+        with self._lock:
+            windows: list = [(key, self._take(key)) for key in list(self._windows)]
+        for key, state in windows:
+            self._close(key, state)
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+
+class DigestState:
+    __slots__ = ('request_type', 'count', 'size', 'files', 'more_files', 'first', 'last')
+
+    def __init__(self, request_type: str):
+        self.request_type: str = request_type
+        self.count: int = 0
+        self.size: int = 0
+        # упорядоченное множество: файлы перечисляются в порядке первого появления
+        self.files: Dict[str, None] = {}
+        self.more_files: bool = False
+        self.first: float = time.time()
+        self.last: float = self.first
+
+
+class Digest(WindowAggregator):
+    """Summary of webhooks of one request type per tenant and owner over an interval
+
+    The summary is sent as one kChat event from the owner: number of
+    webhooks, total size and distinct files, of which the first
+    max_files are remembered and the first LISTED_FILES are listed.
+    """
+
+    def __init__(self, request_type: str, interval: float, max_owners: int, max_files: int, send: Callable):
+        self.request_type: str = request_type
+        self.max_files: int = max_files
+        self.send = send
+        super().__init__(f'digest-{request_type}', interval, max_owners)
+
+    def add_webhook(self, tenant: str, creator: EventCreator) -> None:
+        self.add((tenant, creator.owner), creator)
+        DIGESTED.inc()
+
+    def open_window(self, key: Tuple[str, str], creator: EventCreator) -> DigestState:
+        state = DigestState(creator.request_type)
+        self.merge(state, creator)
+        return state
+
+    def merge(self, state: DigestState, creator: EventCreator) -> bool:
+        state.count += 1
+        size = creator.data.get('size')
+        if isinstance(size, int):
+            state.size += size
+        path: str = str(creator.file_path)
+        # файлы сверх max_files не запоминаются, в сводке указывается только, что их больше
+        if path not in state.files:
+            if len(state.files) < self.max_files:
+                state.files[path] = None
+            else:
+                state.more_files = True
+        state.last = time.time()
+        return False
+
+    def close_window(self, key: Tuple[str, str], state: DigestState) -> None:
+        tenant, owner = key
+        self.send(tenant, owner, self.request_type, self.make_event(owner, state))
+
+    @staticmethod
+    def make_event(owner: str, state: DigestState) -> EventDescription:
+        files: List[str] = list(state.files)
+        distinct: str = f'более {len(files)}' if state.more_files else str(len(files))
+        text: str = (
+            f'\n{state.request_type}: сводка\n'
+            f'Период: {datetime.fromtimestamp(int(state.first))} - {datetime.fromtimestamp(int(state.last))}\n'
+            f'Владелец: {owner}\n'
+            f'Событий: {state.count}\n'
+            f'Общий размер (bytes): {state.size}\n'
+            f'Разных файлов: {distinct}\n'
+        )
+        text += ''.join(f'{path}\n' for path in files[:LISTED_FILES])
+        if len(files) > LISTED_FILES or state.more_files:
+            text += '...\n'
+
+        return EventDescription(
+            name=f'{state.request_type}: сводка',
+            evt_class=pushapi.ttypes.EventClass.kChat,
+            senders=(owner,),
+            receivers=('All',),
+            messages=(ChatMessage(text=text),),
+        )
+
+
+_digests: Dict[str, Digest] = {}
+_digests_lock = threading.Lock()
+
+
+def get_digest(request_type: str, send: Callable) -> Optional[Digest]:
+    """Return digest of the request type or None if its webhooks are sent one by one
+
+    send(tenant, owner, request_type, event) delivers a summary event.
+    """
+
+    interval: Optional[float] = settings.DIGEST_REQUEST_TYPES.get(request_type)
+    if not interval:
+        return None
+    with _digests_lock:
+        if request_type not in _digests:
+            _digests[request_type] = Digest(
+                request_type, interval, settings.DIGEST_MAX_OWNERS, settings.DIGEST_MAX_FILES, send
+            )
+        return _digests[request_type]
+
+
+def close_digests() -> None:
+    """Send summaries of all open intervals"""
+
+    with _digests_lock:
+        digests: List[Digest] = list(_digests.values())
+        _digests.clear()
+    for digest in digests:
+        digest.close()
+
+
+def _forget_digests() -> None:
+    """Flush threads are not inherited by a forked worker, it starts its own digests"""
+
+    _digests.clear()
+
+
+os.register_at_fork(after_in_child=_forget_digests)
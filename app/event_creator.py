@@ -1,31 +1,31 @@
 from abc import abstractmethod
-from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional, Tuple
 
 import pushapi.ttypes
 from config import logger, settings
 from pushapi import pushapi_wrappers as wrappers
 
 
-@dataclass
-class ChatMessage:
+# Описания событий хранятся в очередях до отправки, поэтому они tuple-based и не имеют __dict__.
+# Трифтовые структуры (Identity, Attribute, ChatMessage) строятся только при отправке.
+class ChatMessage(NamedTuple):
     text: str
     sent_time: str = 'now'
     sender_no: int = 0
 
 
-@dataclass
-class EventDescription:
+class EventDescription(NamedTuple):
     name: str
-    evt_class: object
-    senders: list
-    receivers: list
+    evt_class: int
+    senders: Tuple[str, ...]
+    receivers: Tuple[str, ...]
     service: str = 'im_skype'
     data_file: Optional[str] = None
-    data_attrs: Optional[list] = None
-    messages: Optional[list] = None
+    data_attrs: Tuple[Tuple[str, str], ...] = ()
+    messages: Tuple[ChatMessage, ...] = ()
 
 
 class SkypePerson(wrappers.PersonIdentity):
@@ -47,13 +47,14 @@ class EventCreator:
     def __init__(self, data: dict, text: str = ''):
         self.data: dict = data
         self.text: str = text
-        self.sender: Optional[SkypePerson] = None
-        self.receiver: Optional[SkypePerson] = None
+        self.sender: Optional[str] = None
+        self.receiver: Optional[str] = None
         self.request_type: str = 'OwnCloud: unrecognized request type'
         self.event_type: pushapi.ttypes.EventClass = pushapi.ttypes.EventClass.kChat
         self.file_path: Path = Path(self.data['path'])
         self.file_name: str = Path(self.data['path']).name
         self.owner: str = self.data['owner']
+        self.owncloud_host: str = settings.OWNCLOUD_HOST
         self.permissions: str = self.get_permissions_message()
         self.message: str = self.get_base_message()
 
@@ -102,17 +103,17 @@ class EventCreator:
     def create_event(self):
         pass
 
-    def _get_sender(self):
-        self.sender = SkypePerson(self.owner)
+    def _get_sender(self) -> str:
+        self.sender = self.owner
         if not self.sender:
             self.sender = 'All'
         return self.sender
 
-    def _get_receiver(self):
+    def _get_receiver(self) -> str:
         receiver: str = self.data.get('share_with', 'All')
         if not receiver:
             receiver = "All"
-        self.receiver = SkypePerson(receiver)
+        self.receiver = receiver
         return self.receiver
 
 
@@ -121,18 +122,18 @@ class EventCreatorWithMessage(EventCreator):
 
     def create_event(self):
         message: ChatMessage = self._create_message_instance()
-        sender: SkypePerson = self._get_sender()
-        receiver: SkypePerson = self._get_receiver()
+        sender: str = self._get_sender()
+        receiver: str = self._get_receiver()
 
         return EventDescription(
             name=self.request_type,
             evt_class=self.event_type,
-            senders=[sender],
-            receivers=[receiver],
-            messages=[message],
+            senders=(sender,),
+            receivers=(receiver,),
+            messages=(message,),
             service='im_skype',
             data_file=None,
-            data_attrs=[],
+            data_attrs=(),
         )
 
     def _create_message_instance(self):
@@ -151,8 +152,9 @@ class EventCreatorWithMessage(EventCreator):
         )
 
     @staticmethod
-    def _get_from_timestamp(stamp: int) -> datetime:
-        return datetime.fromtimestamp(stamp)
+    @lru_cache(maxsize=4096)
+    def _get_from_timestamp(stamp: int) -> str:
+        return str(datetime.fromtimestamp(stamp))
 
     @abstractmethod
     def _get_message(self) -> str:
@@ -168,7 +170,7 @@ class NodeCreateEvent(EventCreatorWithMessage):
         self.message = f'\n{self.request_type}:\n' + self.message
 
     def _get_message(self):
-        date_time: datetime = self._get_from_timestamp(self.data.get('datetime'))
+        date_time: str = self._get_from_timestamp(self.data.get('datetime'))
         self.message += (
             f'Размер файла (bytes): {self.data.get("size")}\n'
             f'Дата создания файла: {date_time}\n'
@@ -207,7 +209,7 @@ class NodeShareEvent(EventCreatorWithMessage):
         self.message = f'\n{self.request_type}:\n' + self.message
 
     def _get_full_link(self, link: str) -> str:
-        return f'{settings.OWNCLOUD_HOST}{link}'
+        return f'{self.owncloud_host}{link}'
 
     def _get_share_type(self):
 
@@ -220,7 +222,8 @@ class NodeShareEvent(EventCreatorWithMessage):
 
         share_type: str = self.data.get('share_type')
         result = ''
-        if share_type:
+        # share_type 0 (для пользователя) - тоже тип открытия доступа
+        if share_type is not None and share_type != '':
             result += share_types.get(str(share_type), 'Share type not defined')
             if str(share_type) == '3':
                 public_link_path: str = self.data.get('public_link_path')
@@ -264,19 +267,19 @@ class FileTransmittingEvent(EventCreator):
     def create_event(self):
         """Return event for Traffic monitor pushapi script"""
 
-        sender: SkypePerson = self._get_sender()
-        receiver: SkypePerson = self._get_receiver()
+        sender: str = self._get_sender()
+        receiver: str = self._get_receiver()
         file_name = self.data['uploaded_file']
-        file_data_attrs = [
-            pushapi.ttypes.Attribute(name="filename", value=file_name),
-        ]
+        file_data_attrs = (
+            ("filename", file_name),
+        )
 
         return EventDescription(
             name=self.request_type,
             evt_class=self.event_type,
-            senders=[sender],
-            receivers=[receiver],
-            messages=[],  # должен быть пустым при отправке файла
+            senders=(sender,),
+            receivers=(receiver,),
+            messages=(),  # должен быть пустым при отправке файла
             service='im_skype',
             data_file=file_name,
             data_attrs=file_data_attrs,
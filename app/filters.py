@@ -0,0 +1,256 @@
+"""Filtering of OwnCloud webhooks before events are created
+
+Rules are read from a JSON file (FILTER_RULES_FILE):
+
+    {
+        "default": "include",
+        "rules": [
+            {"name": "thumbnails", "action": "exclude", "paths": ["/*/thumbnails/**"]},
+            {"name": "temp files", "action": "exclude", "paths": ["**/*.part", "**/.~lock.*#"]},
+            {"name": "admin", "action": "include", "owners": ["admin"]},
+            {"name": "small downloads", "action": "exclude", "request_types": ["node_downloaded"], "max_size": 1024}
+        ]
+    }
+
+Conditions of a rule must all match, values of a condition are
+alternatives, omitted conditions match anything. The first matching rule
+decides, webhooks matching no rule get the default action.
+
+In path globs "*" and "?" do not cross "/", "**" does. Literal paths and
+literal directories ("/admin/files_trashbin/**") go into a trie of path
+segments, the other globs into one regex, so a webhook is matched against
+all path conditions in a single walk plus a single regex call.
+"""
+import json
+import re
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set
+
+import metrics
+from config import logger, settings
+
+FILTERED = metrics.counter('webhooks_filtered_total', 'Webhooks dropped by filter rules')
+
+ACTIONS: Dict[str, bool] = {'include': True, 'exclude': False}
+_WILDCARD = re.compile(r'(\*\*|\*|\?)')
+
+
+class Rule(NamedTuple):
+    name: str
+    include: bool
+    has_paths: bool
+    owners: Optional[FrozenSet[str]]
+    request_types: Optional[FrozenSet[str]]
+    min_size: Optional[int]
+    max_size: Optional[int]
+
+
+class _Node:
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        # правила, для которых путь узла - сам файл, и правила на весь каталог узла
+        self.exact: List[int] = []
+        self.prefix: List[int] = []
+
+
+class PathTrie:
+    """Literal paths and directories of rules, keyed by path segments"""
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, path: str, rule: int, prefix: bool) -> None:
+        node: _Node = self.root
+        for segment in _segments(path):
+            node = node.children.setdefault(segment, _Node())
+        (node.prefix if prefix else node.exact).append(rule)
+
+    def match(self, path: str) -> Set[int]:
+        matched: Set[int] = set(self.root.prefix)
+        node: Optional[_Node] = self.root
+        for segment in _segments(path):
+            node = node.children.get(segment)
+            if node is None:
+                return matched
+            matched.update(node.prefix)
+        matched.update(node.exact)
+        return matched
+
+
+def _segments(path: str) -> List[str]:
+    return [segment for segment in path.split('/') if segment]
+
+
+def glob_to_regex(glob: str) -> str:
+    parts: List[str] = []
+    # "<dir>/**" подходит и самому каталогу, как и в дереве путей
+    directory: bool = glob.endswith('/**')
+    for part in _WILDCARD.split(glob[:-3] if directory else glob):
+        if part == '**':
+            parts.append('.*')
+        elif part == '*':
+            parts.append('[^/]*')
+        elif part == '?':
+            parts.append('[^/]')
+        else:
+            parts.append(re.escape(part))
+    if directory:
+        parts.append('(?:/.*)?')
+    return ''.join(parts)
+
+
+def _literal_prefix(glob: str) -> Optional[str]:
+    """Return directory of a "<literal dir>/**" glob, None if the glob is not one"""
+
+    if glob.endswith('/**') and not _WILDCARD.search(glob[:-3]):
+        return glob[:-3]
+    return None
+
+
+def _size(rule: dict, field: str, number: int) -> Optional[int]:
+    value = rule.get(field)
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+        raise ValueError(f"Filter rule {number}: {field} must be a number of bytes")
+    return value
+
+
+def _strings(rule: dict, field: str, number: int) -> Optional[FrozenSet[str]]:
+    values = rule.get(field)
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise ValueError(f"Filter rule {number}: {field} must be a list of strings")
+    return frozenset(values)
+
+
+def _webhook_size(value) -> Optional[int]:
+    """Size of the webhook in bytes, OwnCloud may send it as a string, an invalid one counts as missing"""
+
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class WebhookFilter:
+    """Include/exclude rules compiled for matching webhooks in microseconds"""
+
+    def __init__(self, config: dict):
+        default: str = config.get('default', 'include')
+        if default not in ACTIONS:
+            raise ValueError(f"Filter default action must be one of {', '.join(ACTIONS)}, not {default!r}")
+        self.default: bool = ACTIONS[default]
+        self.rules: List[Rule] = []
+        self._trie = PathTrie()
+        # номер правила по номеру группы регулярного выражения
+        self._groups: List[int] = []
+        alternatives: List[str] = []
+        for number, rule in enumerate(config.get('rules', [])):
+            action: str = rule.get('action')
+            if action not in ACTIONS:
+                raise ValueError(f"Filter rule {number}: action must be one of {', '.join(ACTIONS)}, not {action!r}")
+            paths: Optional[FrozenSet[str]] = _strings(rule, 'paths', number)
+            for glob in sorted(paths or ()):
+                if not glob.startswith(('/', '*')):
+                    raise ValueError(f"Filter rule {number}: path glob {glob!r} must start with / or *")
+                directory: Optional[str] = _literal_prefix(glob)
+                if directory is not None:
+                    self._trie.add(directory, number, prefix=True)
+                elif not _WILDCARD.search(glob):
+                    self._trie.add(glob, number, prefix=glob.endswith('/'))
+                else:
+                    self._groups.append(number)
+                    # каждый шаблон проверяется опережающей проверкой, так один вызов находит все совпадения
+                    alternatives.append(f'(?:(?=({glob_to_regex(glob)})\\Z)|)')
+            self.rules.append(Rule(
+                name=rule.get('name', f'rule {number}'), include=ACTIONS[action], has_paths=paths is not None,
+                owners=_strings(rule, 'owners', number), request_types=_strings(rule, 'request_types', number),
+                min_size=_size(rule, 'min_size', number), max_size=_size(rule, 'max_size', number),
+            ))
+        self._regex = re.compile(''.join(alternatives), re.DOTALL) if alternatives else None
+        self._has_paths: bool = any(rule.has_paths for rule in self.rules)
+        # правила без условия на путь, заранее отобранные по типу запроса
+        pathless: List[int] = [number for number, rule in enumerate(self.rules) if not rule.has_paths]
+        self._pathless_any: List[int] = [number for number in pathless if self.rules[number].request_types is None]
+        self._pathless: Dict[str, List[int]] = {
+            request_type: [
+                number for number in pathless
+                if self.rules[number].request_types is None or request_type in self.rules[number].request_types
+            ]
+            for rule in self.rules for request_type in rule.request_types or ()
+        }
+
+    def _path_matches(self, path: str) -> Set[int]:
+        matched: Set[int] = self._trie.match(path)
+        if self._regex is not None:
+            found = self._regex.match(path)
+            for group, number in enumerate(self._groups, 1):
+                if found.start(group) >= 0:
+                    matched.add(number)
+        return matched
+
+    def match(self, data: dict) -> Optional[Rule]:
+        """Return the first rule matching the webhook or None"""
+
+        request_type = data.get('request_type')
+        # проверяются только правила, путь которых совпал, и правила без пути
+        candidates: Set[int] = self._path_matches(data.get('path', '')) if self._has_paths else set()
+        candidates.update(self._pathless.get(request_type, self._pathless_any))
+        size: Optional[int] = _webhook_size(data.get('size'))
+        for number in sorted(candidates):
+            rule: Rule = self.rules[number]
+            if rule.request_types is not None and request_type not in rule.request_types:
+                continue
+            if rule.owners is not None and data.get('owner') not in rule.owners:
+                continue
+            # правило с порогом размера не подходит вебхуку без размера
+            if rule.min_size is not None and (size is None or size < rule.min_size):
+                continue
+            if rule.max_size is not None and (size is None or size > rule.max_size):
+                continue
+            return rule
+        return None
+
+    def accept(self, data: dict) -> bool:
+        """Return True if an event must be created and sent for the webhook"""
+
+        rule: Optional[Rule] = self.match(data)
+        if rule is None:
+            return self.default
+        if not rule.include:
+            logger.debug(f"Webhook {data.get('request_type')} {data.get('path')} dropped by filter [{rule.name}]")
+        return rule.include
+
+
+def load_filter(path: str) -> WebhookFilter:
+    with open(path, encoding='utf-8') as stream:
+        return WebhookFilter(json.load(stream))
+
+
+_filter: Optional[WebhookFilter] = None
+_loaded: bool = False
+
+
+def get_filter() -> Optional[WebhookFilter]:
+    """Return filter compiled from FILTER_RULES_FILE or None when no file is set"""
+
+    global _filter, _loaded
+    if not _loaded:
+        _filter = load_filter(settings.FILTER_RULES_FILE) if settings.FILTER_RULES_FILE else None
+        _loaded = True
+    return _filter
+
+
+def accept_webhook(data: dict) -> bool:
+    """Apply filter rules to the webhook, dropped webhooks are counted"""
+
+    webhook_filter: Optional[WebhookFilter] = get_filter()
+    if webhook_filter is None or webhook_filter.accept(data):
+        return True
+    FILTERED.inc()
+    return False
@@ -0,0 +1,40 @@
+import time
+from typing import Callable, Dict
+
+from config import logger
+
+_started: float = time.time()
+_probes: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, probe: Callable[[], dict]) -> None:
+    """Register component state probe
+
+    Probe must be cheap (no network calls) and return a dict with optional
+    'alive' and 'ready' flags (True by default) plus any details to report.
+    """
+
+    _probes[name] = probe
+
+
+def report() -> dict:
+    """Return state of all registered components"""
+
+    checks: dict = {}
+    alive = ready = True
+    for name, probe in _probes.items():
+        try:
+            state: dict = probe()
+        except Exception as err:
+            logger.exception(f"Health probe [{name}] failed: {err}")
+            state = {'alive': False, 'ready': False, 'error': str(err)}
+        alive = alive and state.get('alive', True)
+        ready = ready and state.get('ready', True)
+        checks[name] = state
+
+    return {
+        'alive': alive,
+        'ready': ready,
+        'uptime': round(time.time() - _started, 3),
+        'checks': checks,
+    }
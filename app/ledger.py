@@ -0,0 +1,336 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from config import logger, logs_dir_full_path, settings
+
+# Строка на каждое получение вебхука: одинаковые вебхуки имеют общий отпечаток, но разные delivery_id
+SCHEMA: str = '''
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY,
+    delivery_id TEXT NOT NULL UNIQUE,
+    fingerprint TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    request_type TEXT NOT NULL,
+    path TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    latency REAL,
+    guid TEXT,
+    error TEXT,
+    size INTEGER,
+    digests TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deliveries_fingerprint ON deliveries (fingerprint, updated_at);
+CREATE INDEX IF NOT EXISTS deliveries_path ON deliveries (path, updated_at);
+CREATE INDEX IF NOT EXISTS deliveries_owner ON deliveries (owner, updated_at);
+CREATE INDEX IF NOT EXISTS deliveries_updated ON deliveries (updated_at);
+'''
+
+# Повторная запись той же доставки обновляет статус, время получения сохраняется.
+UPSERT: str = '''
+INSERT INTO deliveries (
+    delivery_id, fingerprint, tenant, request_type, path, owner, status, attempts, latency, guid, error,
+    size, digests, created_at, updated_at
+) VALUES (
+    :delivery_id, :fingerprint, :tenant, :request_type, :path, :owner, :status, :attempts, :latency, :guid, :error,
+    :size, :digests, :at, :at
+)
+ON CONFLICT (delivery_id) DO UPDATE SET
+    status = excluded.status,
+    attempts = max(deliveries.attempts, excluded.attempts),
+    latency = coalesce(excluded.latency, deliveries.latency),
+    guid = coalesce(excluded.guid, deliveries.guid),
+    error = excluded.error,
+    size = coalesce(excluded.size, deliveries.size),
+    digests = coalesce(excluded.digests, deliveries.digests),
+    updated_at = excluded.updated_at
+'''
+
+# Журнал прежних версий хранил строку на отпечаток, отпечаток становится идентификатором её доставки
+MIGRATE_V1: tuple = (
+    'DROP INDEX IF EXISTS deliveries_path',
+    'DROP INDEX IF EXISTS deliveries_owner',
+    'DROP INDEX IF EXISTS deliveries_updated',
+    'ALTER TABLE deliveries RENAME TO deliveries_v1',
+    *(statement for statement in SCHEMA.split(';') if statement.strip()),
+    '''
+    INSERT INTO deliveries (
+        delivery_id, fingerprint, tenant, request_type, path, owner, status, attempts, latency, guid, error,
+        created_at, updated_at
+    )
+    SELECT fingerprint, fingerprint, tenant, request_type, path, owner, status, attempts, latency, guid, error,
+        created_at, updated_at
+    FROM deliveries_v1 ORDER BY created_at
+    ''',
+    'DROP TABLE deliveries_v1',
+)
+
+# Размер и контрольные суммы переданных потоков
+MIGRATE_V2: tuple = (
+    'ALTER TABLE deliveries ADD COLUMN size INTEGER',
+    'ALTER TABLE deliveries ADD COLUMN digests TEXT',
+)
+
+COLUMNS = (
+    'id', 'delivery_id', 'fingerprint', 'tenant', 'request_type', 'path', 'owner', 'status',
+    'attempts', 'latency', 'guid', 'error', 'size', 'digests', 'created_at', 'updated_at',
+)
+
+
+def fingerprint(tenant: str, data: dict) -> str:
+    """Return fingerprint of the webhook, OwnCloud resending the same webhook gets the same one"""
+
+    payload: str = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(f'{tenant}\n{payload}'.encode('utf-8')).hexdigest()
+
+
+def new_delivery_id() -> str:
+    """Return id of a webhook arrival, retries and replays of its event keep it"""
+
+    return uuid.uuid4().hex
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def _migrate(connection: sqlite3.Connection) -> None:
+    """Convert ledger of an earlier version in place, prefork workers wait for the one converting it"""
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        columns: list = [row[1] for row in connection.execute('PRAGMA table_info(deliveries)')]
+        if columns and 'delivery_id' not in columns:
+            for statement in MIGRATE_V1:
+                connection.execute(statement)
+            logger.warning("Delivery ledger is converted to one record per webhook arrival")
+        elif columns and 'digests' not in columns:
+            for statement in MIGRATE_V2:
+                connection.execute(statement)
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+class Ledger:
+    """Delivery ledger in SQLite written by a background thread in batches
+
+    Webhook and delivery threads only put records into a queue. The writer
+    thread commits them in one transaction per batch, so the request path
+    never waits for the disk. WAL mode lets queries and prefork workers
+    read while another process writes.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.5, guid_cache_size: int = 10000):
+        self.path: str = path
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.guid_cache_size: int = guid_cache_size
+        self._records: queue.SimpleQueue = queue.SimpleQueue()
+        self._guids: OrderedDict = OrderedDict()
+        self._guids_lock = threading.Lock()
+        # один общий читатель: запросы короткие, а соединение на поток запроса не закрывалось бы
+        self._reader: Optional[sqlite3.Connection] = None
+        self._reader_lock = threading.Lock()
+        connection: sqlite3.Connection = connect(path)
+        try:
+            _migrate(connection)
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+        self._thread = threading.Thread(target=self._run, name='ledger', daemon=True)
+        self._thread.start()
+
+    def record(
+            self,
+            delivery_id: str,
+            fingerprint: str,
+            tenant: str,
+            request_type: str,
+            path: str,
+            owner: str,
+            status: str,
+            attempts: int = 0,
+            latency: Optional[float] = None,
+            guid: Optional[str] = None,
+            error: Optional[str] = None,
+            size: Optional[int] = None,
+            digests: Optional[dict] = None
+    ) -> None:
+        """Queue delivery state for writing, size and digests are those of the streams sent"""
+
+        self._records.put({
+            'delivery_id': delivery_id, 'fingerprint': fingerprint, 'tenant': tenant, 'request_type': request_type,
+            'path': path, 'owner': owner, 'status': status, 'attempts': attempts,
+            'latency': latency, 'guid': None if guid is None else str(guid), 'error': error,
+            'size': size, 'digests': None if digests is None else json.dumps(digests, sort_keys=True),
+            'at': time.time(),
+        })
+
+    def _run(self) -> None:
+        connection: sqlite3.Connection = connect(self.path)
+        stopping: bool = False
+        while not stopping:
+            # пачка набирается до batch_size записей или flush_interval секунд от первой записи
+            record: Optional[dict] = self._records.get()
+            batch: list = []
+            deadline: float = time.monotonic() + self.flush_interval
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._records.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            if batch:
+                self._write(connection, batch)
+        connection.close()
+
+    @staticmethod
+    def _write(connection: sqlite3.Connection, batch: List[dict]) -> None:
+        try:
+            with connection:
+                connection.executemany(UPSERT, batch)
+        except sqlite3.Error as err:
+            logger.error(f"Ledger write of {len(batch)} records failed: {err}")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Write queued records and stop the writer thread"""
+
+        self._records.put(None)
+        self._thread.join(timeout)
+        with self._reader_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _query(self, query: str, params) -> list:
+        """Run a query on the shared reader connection"""
+
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = connect(self.path)
+            return self._reader.execute(query, params).fetchall()
+
+    def delivered_guid(self, delivery_id: str, lookup: bool = True) -> Optional[str]:
+        """Return guid of the webhook arrival if PushAPI has already accepted its event
+
+        Only retries and replays of the same arrival are recognized: a webhook
+        OwnCloud sends again with the same payload is a new arrival and is sent.
+        Recent guids are kept in a bounded LRU map, older ones are looked up
+        in the ledger when lookup is set, so a replay is recognized after restart too.
+        """
+
+        with self._guids_lock:
+            guid: Optional[str] = self._guids.get(delivery_id)
+            if guid is not None:
+                self._guids.move_to_end(delivery_id)
+                return guid
+        if not lookup:
+            return None
+        rows: list = self._query(
+            'SELECT guid FROM deliveries WHERE delivery_id = ? AND guid IS NOT NULL', (delivery_id,)
+        )
+        if not rows:
+            return None
+        self._remember(delivery_id, rows[0][0])
+        return rows[0][0]
+
+    def remember_guid(self, delivery_id: str, guid) -> None:
+        """Remember guid right after delivery, before the ledger record is written"""
+
+        self._remember(delivery_id, str(guid))
+
+    def _remember(self, delivery_id: str, guid: str) -> None:
+        with self._guids_lock:
+            self._guids[delivery_id] = guid
+            self._guids.move_to_end(delivery_id)
+            while len(self._guids) > self.guid_cache_size:
+                self._guids.popitem(last=False)
+
+    def find(
+            self,
+            delivery_id: Optional[str] = None,
+            fingerprint: Optional[str] = None,
+            path: Optional[str] = None,
+            owner: Optional[str] = None,
+            status: Optional[str] = None,
+            since: Optional[float] = None,
+            limit: int = 100
+    ) -> List[dict]:
+        """Return the latest deliveries matching all given conditions"""
+
+        conditions: list = []
+        params: list = []
+        for column, value in (
+                ('delivery_id', delivery_id), ('fingerprint', fingerprint), ('path', path), ('owner', owner),
+                ('status', status)
+        ):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            conditions.append('updated_at >= ?')
+            params.append(since)
+        where: str = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        params.append(limit)
+        rows: list = self._query(
+            f"SELECT {', '.join(COLUMNS)} FROM deliveries {where} ORDER BY updated_at DESC LIMIT ?", params
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+
+_ledger: Optional[Ledger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> Optional[Ledger]:
+    """Return delivery ledger of the process or None when it is disabled"""
+
+    global _ledger
+    if not settings.LEDGER_ENABLED:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger(
+                settings.LEDGER_PATH or str(logs_dir_full_path / 'ledger.db'),
+                batch_size=settings.LEDGER_BATCH_SIZE, flush_interval=settings.LEDGER_FLUSH_INTERVAL,
+                guid_cache_size=settings.LEDGER_GUID_CACHE_SIZE
+            )
+    return _ledger
+
+
+def close_ledger(timeout: Optional[float] = None) -> None:
+    global _ledger
+    with _ledger_lock:
+        ledger, _ledger = _ledger, None
+    if ledger is not None:
+        ledger.close(timeout)
+
+
+def _forget_ledger() -> None:
+    """Writer thread is not inherited by a forked worker, it starts its own"""
+
+    global _ledger
+    _ledger = None
+
+
+os.register_at_fork(after_in_child=_forget_ledger)
@@ -1,27 +1,180 @@
-from flask import Flask, request, Request
+import atexit
+import importlib
+import time
+from typing import Optional, Tuple
 
+from flask import Flask, Response, request, Request
+
+import health
+import metrics
+import ratelimit
 from config import settings, logger
 from event_creator import (
     EventDescription, NodeCreateEvent, NodeShareEvent, NodeDownloadEvent,
     NodeShareChangePermissionEvent, EventCreator
 )
+from coalesce import close_share_coalescer, get_share_coalescer
+from delivery import Delivery, DeliveryScheduler, close_scheduler, get_scheduler
+from digest import close_digests, get_digest
+from filters import accept_webhook, get_filter
+from pool import get_pool, get_pools, pools_health
 from sender import TrafficMonitor
+from tenants import Tenant, get_tenant, get_tenants, resolve_tenant
 
 app = Flask(__name__)
+health.register('pushapi_pool', pools_health)
 
+# Клиент PushAPI загружается при первой доставке. В режиме prefork мастер импортирует его до gc.freeze(),
+# чтобы воркеры не загружали его каждый сам, а делили страницы мастера
+PRELOAD_MODULES: Tuple[str, ...] = ('thrift.transport.TSSLSocket', 'pushapi.EventProcessor')
 
-def send_message_to_traffic_monitor(event: EventDescription) -> None:
-    """Send event to Traffic Monitor using settings from .env file"""
 
-    logger.debug(f"Send event to Traffic Monitor...")
-    sender = TrafficMonitor(
-        event=event, host=settings.HOST_DFL, port=settings.PORT_DFL,
-        name=settings.NAME_DFL, token=settings.TOKEN_DFL
+def deliver(event: EventDescription, tenant_name: str = None, meta: dict = None, replayed: bool = False) -> int:
+    """Send event to Traffic Monitor with PushAPI account of the tenant, return its guid, errors are raised
+
+    A retry or replay of a webhook arrival PushAPI has already accepted (same delivery id)
+    is not sent again. Retries are checked against guids remembered in memory, only a
+    replayed stored event, which may have been accepted before a restart, is looked up in the ledger.
+    Size and digests of the streams sent are added to meta and written with the delivery state.
+    """
+
+    ledger = _ledger()
+    webhook: str = meta and meta.get('delivery_id')
+    if ledger is not None and webhook:
+        guid = ledger.delivered_guid(webhook, lookup=replayed)
+        if guid is not None:
+            metrics.DELIVERY_DUPLICATES.inc()
+            logger.debug(f"Delivery {webhook} is already accepted with guid {guid}, skipped")
+            return guid
+
+    tenant: Tenant = get_tenant(tenant_name)
+    # лимит лицензии Traffic Monitor: событие ждёт своей очереди до того, как займёт соединение пула
+    ratelimit.acquire_event()
+    with get_pool(tenant).connection() as client:
+        sender = TrafficMonitor(
+            event=event, host=tenant.host, port=tenant.port,
+            name=tenant.company_name, token=tenant.token, client=client
+        )
+        guid = sender.send_message()
+    if ledger is not None and webhook:
+        ledger.remember_guid(webhook, guid)
+        if sender.streams:
+            # размер и контрольные суммы потоков записываются в журнал вместе с итогом доставки
+            meta['size'] = sum(digest.size for digest in sender.streams.values())
+            meta['digests'] = {data_id: digest.hexdigests() for data_id, digest in sender.streams.items()}
+    return guid
+
+
+def _deliver_or_store(event: EventDescription, tenant_name: str = None, meta: dict = None):
+    """Deliver event, while PushAPI server is unreachable it is stored on disk and None is returned"""
+
+    outbox = _outbox()
+    if outbox is None:
+        return deliver(event, tenant_name, meta)
+    return outbox.deliver(event, tenant_name, meta)
+
+
+def _delivery_status(guid, error: Exception = None) -> str:
+    if error:
+        return 'failed'
+    return 'spooled' if guid is None else 'delivered'
+
+
+def _record_delivery(meta: dict, status: str, **fields) -> None:
+    """Write delivery state of the webhook to the ledger"""
+
+    ledger = _ledger()
+    if ledger is not None and meta:
+        ledger.record(status=status, **meta, **fields)
+
+
+def _report_delivery(delivery: Delivery, guid, error: Exception = None) -> None:
+    _record_delivery(
+        delivery.meta, _delivery_status(guid, error), attempts=delivery.attempts,
+        latency=time.monotonic() - delivery.enqueued_at, guid=guid, error=error and str(error)
     )
+
+
+def _report_replay(meta: dict, guid, error: Exception = None) -> None:
+    _record_delivery(meta, _delivery_status(guid, error), guid=guid, error=error and str(error))
+
+
+def _scheduler() -> DeliveryScheduler:
+    return get_scheduler(_deliver_or_store, _report_delivery)
+
+
+def _outbox():
+    """Outbox of the process or None, spool modules are loaded only when store-and-forward is enabled"""
+
+    if not settings.SPOOL_ENABLED:
+        return None
+    from outbox import get_outbox
+
+    return get_outbox(deliver, _report_replay)
+
+
+def _ledger():
+    """Delivery ledger of the process or None, sqlite3 is loaded only when the ledger is enabled"""
+
+    if not settings.LEDGER_ENABLED:
+        return None
+    from ledger import get_ledger
+
+    return get_ledger()
+
+
+def _webhook_meta(tenant: Tenant, data: dict, creator: EventCreator) -> Optional[dict]:
+    """Ledger details of the webhook arrival, None when the ledger is disabled"""
+
+    if not settings.LEDGER_ENABLED:
+        return None
+    from ledger import fingerprint, new_delivery_id
+
+    return {
+        'delivery_id': new_delivery_id(), 'fingerprint': fingerprint(tenant.name, data),
+        'tenant': tenant.name, 'request_type': data['request_type'], 'path': str(creator.file_path),
+        'owner': creator.owner,
+    }
+
+
+def _outbox_health() -> dict:
+    if not settings.SPOOL_ENABLED:
+        return {'enabled': False}
+    return _outbox().health()
+
+
+def _delivery_health() -> dict:
+    if not settings.DELIVERY_WORKERS:
+        return {'partitions': 0}
+    return _scheduler().health()
+
+
+health.register('delivery', _delivery_health)
+health.register('outbox', _outbox_health)
+
+
+def send_message_to_traffic_monitor(
+        event: EventDescription,
+        key: str = '',
+        lane: str = None,
+        tenant_name: str = None,
+        meta: dict = None
+) -> None:
+    """Send event to Traffic Monitor or queue it for delivery in order of its key"""
+
+    if settings.DELIVERY_WORKERS:
+        _record_delivery(meta, 'queued')
+        _scheduler().submit(key, event, lane, tenant_name, meta)
+        return
+    logger.debug(f"Send event to Traffic Monitor...")
+    started: float = time.monotonic()
     try:
-        sender.send_message()
+        guid = _deliver_or_store(event, tenant_name, meta)
     except Exception as err:
         logger.error(err)
+        _record_delivery(meta, 'failed', attempts=1, latency=time.monotonic() - started, error=str(err))
+    else:
+        _record_delivery(meta, _delivery_status(guid), attempts=1, latency=time.monotonic() - started, guid=guid)
     logger.debug(f"Send event to Traffic Monitor: OK")
 
 
@@ -48,7 +201,35 @@ def _get_event(data: dict, text: str = '') -> EventDescription:
     return creator(data, text).create_event()
 
 
-def _send_message(request: Request) -> None:
+def _get_delivery_key(creator: EventCreator) -> str:
+    """Return key of events that must be delivered in order"""
+
+    if settings.DELIVERY_KEY == 'owner':
+        return creator.owner
+    return str(creator.file_path)
+
+
+def _get_delivery_lane(data: dict) -> str:
+    """Return priority lane of the event, public links are matched by share type"""
+
+    request_type: str = data['request_type']
+    rules: dict = settings.DELIVERY_LANE_RULES
+
+    return rules.get(f"{request_type}:{data.get('share_type')}") or rules.get(request_type)
+
+
+def _send_digest(tenant_name: str, owner: str, request_type: str, event: EventDescription) -> None:
+    send_message_to_traffic_monitor(event, owner, _get_delivery_lane({'request_type': request_type}), tenant_name)
+
+
+def _send_coalesced(tenant_name: str, key: str, lane: str, event: EventDescription, metas: list) -> None:
+    # событие отправляется за первый вебхук, остальные отмечаются в журнале как вошедшие в него
+    for meta in metas[1:]:
+        _record_delivery(meta, 'coalesced')
+    send_message_to_traffic_monitor(event, key, lane, tenant_name, metas[0])
+
+
+def _send_message(request: Request, tenant_name: str = None) -> None:
     """Create event and send it to Traffic monitor"""
 
     logger.debug("Sending message...")
@@ -57,8 +238,30 @@ def _send_message(request: Request) -> None:
         data = request.json
         logger.debug(f'\n\n{data}\n')
         if request.is_json:
-            event: EventDescription = _get_event(data, text)
-            send_message_to_traffic_monitor(event)
+            # отфильтрованный вебхук не создаёт событие и не занимает соединение
+            if not accept_webhook(data):
+                return
+            tenant: Tenant = resolve_tenant(tenant_name, request.headers, data)
+            creator: EventCreator = _get_event_creator(data)(data, text)
+            creator.owncloud_host = tenant.owncloud_host
+            meta: Optional[dict] = _webhook_meta(tenant, data, creator)
+            # вебхук в режиме сводки учитывается в ней, отдельного события нет
+            digest = get_digest(data['request_type'], _send_digest)
+            if digest is not None:
+                digest.add_webhook(tenant.name, creator)
+                _record_delivery(meta, 'digested')
+                return
+            event: EventDescription = creator.create_event()
+            key: str = _get_delivery_key(creator)
+            # открытие доступа нескольким получателям сливается в одно событие
+            coalescer = get_share_coalescer(_send_coalesced)
+            if coalescer is not None:
+                if coalescer.accepts(data):
+                    coalescer.add_share(tenant.name, creator, event, meta, key, _get_delivery_lane(data))
+                    return
+                # событие того же ключа не обгоняет задержанное в окне открытие доступа
+                coalescer.flush(tenant.name, key)
+            send_message_to_traffic_monitor(event, key, _get_delivery_lane(data), tenant.name, meta)
     except KeyError as err:
         text = f"Не смог распознать данные от OwnCloud: {err}"
         logger.exception(text)
@@ -68,12 +271,131 @@ def _send_message(request: Request) -> None:
 
 
 @app.route('/get_hook', methods=["POST"])
-def get_hook():
+@app.route('/get_hook/<tenant>', methods=["POST"])
+def get_hook(tenant: str = None):
     """Get POST request and send it to Traffic Monitor"""
 
-    _send_message(request)
+    _send_message(request, tenant)
     return {"result": "get_hook: OK"}
 
 
+@app.route('/healthz', methods=["GET"])
+def healthz():
+    """Liveness probe: process and its workers are alive"""
+
+    state: dict = health.report()
+    return state, 200 if state['alive'] else 503
+
+
+@app.route('/readyz', methods=["GET"])
+def readyz():
+    """Readiness probe: instance can accept webhooks"""
+
+    state: dict = health.report()
+    return state, 200 if state['ready'] else 503
+
+
+@app.route('/deliveries', methods=["GET"])
+def get_deliveries():
+    """Delivery status of webhooks by delivery id, fingerprint, path, owner, status and time (since, unix seconds)"""
+
+    ledger = _ledger()
+    if ledger is None:
+        return {"error": "delivery ledger is disabled"}, 404
+    args = request.args
+    try:
+        since: float = float(args['since']) if 'since' in args else None
+        limit: int = min(int(args.get('limit', 100)), 1000)
+    except ValueError as err:
+        return {"error": str(err)}, 400
+    deliveries: list = ledger.find(
+        delivery_id=args.get('delivery_id'), fingerprint=args.get('fingerprint'), path=args.get('path'),
+        owner=args.get('owner'), status=args.get('status'), since=since, limit=limit
+    )
+    return {"deliveries": deliveries}
+
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    """Metrics of all worker processes in Prometheus text format"""
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def warm_up() -> None:
+    """Open PushAPI connections of all tenants before accepting webhooks, start replay of stored events"""
+
+    get_filter()
+    for tenant in get_tenants().values():
+        if settings.WARMUP_CONNECTIONS:
+            pool = get_pool(tenant)
+            # сервер недоступен при запуске: прогрев повторяется в фоне, до его успеха экземпляр не готов
+            if not pool.warm_up(settings.WARMUP_CONNECTIONS):
+                pool.retry_warm_up(settings.WARMUP_CONNECTIONS, settings.WARMUP_RETRY_INTERVAL)
+        else:
+            get_pool(tenant).ready = True
+    _outbox()
+    logger.debug("Instance is ready")
+
+
+def shutdown() -> None:
+    """Release resources of the serving process, open digests and shares are sent and queued events delivered first"""
+
+    close_digests()
+    close_share_coalescer()
+    close_scheduler(settings.DELIVERY_SHUTDOWN_TIMEOUT)
+    if settings.SPOOL_ENABLED:
+        from outbox import close_outbox
+
+        close_outbox(settings.DELIVERY_SHUTDOWN_TIMEOUT)
+    if settings.LEDGER_ENABLED:
+        from ledger import close_ledger
+
+        close_ledger(settings.DELIVERY_SHUTDOWN_TIMEOUT)
+    for pool in get_pools().values():
+        pool.close()
+
+
+def preload() -> None:
+    """Import modules that workers load on first use, the master imports them before fork"""
+
+    modules: list = list(PRELOAD_MODULES)
+    if settings.SPOOL_ENABLED:
+        modules.append('outbox')
+    if settings.LEDGER_ENABLED:
+        modules.append('ledger')
+    if settings.FILE_SOURCE == 'webdav':
+        modules.append('owncloud')
+    for name in modules:
+        importlib.import_module(name)
+
+
+def start_worker(number: int) -> None:
+    """Prepare forked worker: it gets its own metrics row and PushAPI connection pool"""
+
+    metrics.set_worker(number)
+    warm_up()
+
+
+def stop_worker(number: int) -> None:
+    shutdown()
+
+
 if __name__ == '__main__':
-    app.run(debug=settings.DEBUG, host=settings.APP_HOST, port=settings.APP_PORT)
+    if settings.SERVER_MODE == 'prefork':
+        from server import PreforkServer
+
+        preload()
+        server = PreforkServer(
+            app, host=settings.APP_HOST, port=settings.APP_PORT, workers=settings.WORKERS,
+            reuse_port=settings.REUSE_PORT, on_worker_start=start_worker, on_worker_exit=stop_worker
+        )
+        metrics.init(server.workers)
+        ratelimit.init(server.workers)
+        server.serve()
+    else:
+        metrics.init(1)
+        ratelimit.init(1)
+        warm_up()
+        atexit.register(shutdown)
+        app.run(debug=settings.DEBUG, host=settings.APP_HOST, port=settings.APP_PORT)
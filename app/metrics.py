@@ -0,0 +1,260 @@
+import mmap
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Metrics of all worker processes live in one anonymous shared mmap created
+# before fork. Every worker owns THREAD_SLOTS rows of float64 slots, every
+# thread of the worker writes only its own row, so updates take no lock and
+# /metrics in any worker sums all rows without IPC. Row 0 of a worker is
+# shared by threads beyond THREAD_SLOTS, they update it under the lock.
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+THREAD_SLOTS: int = 64
+
+_metrics: List['Metric'] = []
+_index: Dict[tuple, 'Metric'] = {}
+_row_size: int = 0
+_workers: int = 0
+_buffer: Optional[mmap.mmap] = None
+_values: Optional[memoryview] = None
+_row: int = 0
+_lock = threading.Lock()
+# строки потоков, освобождённые завершившимися потоками, и поколение для сброса после fork
+_free: List[int] = list(range(THREAD_SLOTS - 1, 0, -1))
+_generation: int = 0
+_local = threading.local()
+
+
+class _Slot:
+    """Row of a thread, given back when the thread ends and its locals are released"""
+
+    __slots__ = ('number', 'generation')
+
+    def __init__(self, number: int):
+        self.number: int = number
+        self.generation: int = _generation
+
+    def __del__(self):
+        if self.number and self.generation == _generation:
+            _free.append(self.number)
+
+
+def _slot() -> int:
+    try:
+        return _local.number
+    except AttributeError:
+        pass
+    try:
+        number: int = _free.pop()
+    except IndexError:
+        number = 0
+    _local.slot = _Slot(number)
+    _local.number = number
+    return number
+
+
+def _region() -> memoryview:
+    if _values is None:
+        raise RuntimeError("Metrics are updated before metrics.init() created the shared region")
+    return _values
+
+
+class Metric:
+    kind: str = ''
+
+    def __init__(self, name: str, documentation: str, labels: Dict[str, str], size: int):
+        global _row_size
+        if _buffer is not None:
+            raise RuntimeError(f"Metric [{name}] declared after shared metrics region was created")
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labels: Dict[str, str] = labels
+        self.offset: int = _row_size
+        _row_size += size
+
+    def _add(self, slot: int, value: float) -> None:
+        values: memoryview = _region()
+        thread: int = _slot()
+        position: int = _row + thread * _row_size + self.offset + slot
+        if thread:
+            values[position] += value
+            return
+        with _lock:
+            values[position] += value
+
+    def _label_text(self, extra: str = '') -> str:
+        pairs: list = [f'{key}="{value}"' for key, value in self.labels.items()]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Dict[str, str]):
+        super().__init__(name, documentation, labels, 1)
+
+    def inc(self, value: float = 1) -> None:
+        self._add(0, value)
+
+    def collect(self, row: memoryview) -> List[str]:
+        return [f'{self.name}{self._label_text()} {row[self.offset]:g}']
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float) -> None:
+        values: memoryview = _region()
+        # значение - сумма по строкам потоков, поэтому остаётся только в строке текущего
+        with _lock:
+            for thread in range(THREAD_SLOTS):
+                values[_row + thread * _row_size + self.offset] = 0
+            values[_row + _slot() * _row_size + self.offset] = value
+
+    def dec(self, value: float = 1) -> None:
+        self._add(0, -value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Dict[str, str], buckets: Tuple[float, ...]):
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # slots: bucket counts, +Inf count, sum
+        super().__init__(name, documentation, labels, len(self.buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        values: memoryview = _region()
+        thread: int = _slot()
+        position: int = _row + thread * _row_size + self.offset
+        bucket: int = position + bisect_left(self.buckets, value)
+        total: int = position + len(self.buckets) + 1
+        if thread:
+            values[bucket] += 1
+            values[total] += value
+            return
+        with _lock:
+            values[bucket] += 1
+            values[total] += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def collect(self, row: memoryview) -> List[str]:
+        lines: list = []
+        cumulative: float = 0
+        bounds: list = [f'{bound:g}' for bound in self.buckets] + ['+Inf']
+        for number, bound in enumerate(bounds):
+            cumulative += row[self.offset + number]
+            labels: str = self._label_text('le="%s"' % bound)
+            lines.append(f'{self.name}_bucket{labels} {cumulative:g}')
+        lines.append(f'{self.name}_sum{self._label_text()} {row[self.offset + len(bounds)]:g}')
+        lines.append(f'{self.name}_count{self._label_text()} {cumulative:g}')
+        return lines
+
+
+def _register(cls, name: str, documentation: str, labels: Dict[str, str], *args) -> Metric:
+    key: tuple = (name, tuple(sorted(labels.items())))
+    if key not in _index:
+        metric = cls(name, documentation, labels, *args)
+        _metrics.append(metric)
+        _index[key] = metric
+    return _index[key]
+
+
+def counter(name: str, documentation: str, **labels: str) -> Counter:
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name: str, documentation: str, **labels: str) -> Gauge:
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels: str) -> Histogram:
+    return _register(Histogram, name, documentation, labels, buckets)
+
+
+def init(workers: int) -> None:
+    """Create shared region for given number of workers, must be called before fork"""
+
+    global _buffer, _values, _workers
+    with _lock:
+        if _values is None:
+            _workers = max(workers, 1)
+            _buffer = mmap.mmap(-1, max(_row_size, 1) * THREAD_SLOTS * _workers * 8)
+            _values = memoryview(_buffer).cast('d')
+
+
+def set_worker(number: int) -> None:
+    """Select rows of the current worker process, its gauges are reset"""
+
+    global _row
+    values: memoryview = _region()
+    if not 0 <= number < _workers:
+        raise ValueError(f"Worker number {number} is out of metrics region [0, {_workers})")
+    _row = number * THREAD_SLOTS * _row_size
+    for metric in _metrics:
+        if isinstance(metric, Gauge):
+            for thread in range(THREAD_SLOTS):
+                values[_row + thread * _row_size + metric.offset] = 0
+
+
+def render() -> str:
+    """Return metrics of all workers in Prometheus text format"""
+
+    values: memoryview = _region()
+    total: list = [0.0] * _row_size
+    for start in range(0, _workers * THREAD_SLOTS * _row_size, _row_size):
+        total = [current + value for current, value in zip(total, values[start:start + _row_size])]
+
+    # строки одного семейства метрик должны идти подряд, даже если метки объявлены в разное время
+    families: Dict[str, List[Metric]] = {}
+    for metric in _metrics:
+        families.setdefault(metric.name, []).append(metric)
+    lines: list = []
+    for name, family in families.items():
+        lines.append(f'# HELP {name} {family[0].documentation}')
+        lines.append(f'# TYPE {name} {family[0].kind}')
+        for metric in family:
+            lines.extend(metric.collect(total))
+    return '\n'.join(lines) + '\n'
+
+
+EVENTS_DELIVERED = counter('pushapi_events_delivered_total', 'Events accepted by PushAPI')
+DELIVERY_ERRORS = counter('pushapi_delivery_errors_total', 'Events that failed to be delivered')
+BYTES_STREAMED = counter('pushapi_bytes_streamed_total', 'Bytes sent with SendStreamData')
+DELIVERY_SECONDS = histogram('pushapi_delivery_seconds', 'Time to deliver one event')
+RPC_SECONDS = {
+    method: histogram('pushapi_rpc_seconds', 'PushAPI call latency', method=method)
+    for method in ('BeginEvent', 'SendStreamData', 'EndEvent')
+}
+# Метрики модулей, которые загружаются при первом использовании (журнал, спул), объявлены здесь:
+# после init() новые метрики объявлять нельзя
+DELIVERY_DUPLICATES = counter(
+    'delivery_duplicates_total', 'Events not sent again because PushAPI already accepted them'
+)
+OUTBOX_SPOOLED = counter('outbox_spooled_total', 'Events stored on disk while PushAPI server was unreachable')
+OUTBOX_REPLAYED = counter('outbox_replayed_total', 'Stored events sent to PushAPI server')
+
+
+def _forget_threads() -> None:
+    """Only the forking thread exists in the child, rows of the parent's threads are free again"""
+
+    global _free, _generation, _local
+    _generation += 1
+    _free = list(range(THREAD_SLOTS - 1, 0, -1))
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_forget_threads)
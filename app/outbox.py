@@ -0,0 +1,354 @@
+import fcntl
+import os
+import socket
+import ssl
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from thrift.transport.TTransport import TTransportException
+
+import metrics
+from config import logger, logs_dir_full_path, settings
+from pool import get_pool
+from ratelimit import TokenBucket
+from sender import TrafficMonitor, check_server
+from spool import SpoolError, SpoolReader, SpoolWriter
+from tenants import get_tenant, get_tenants
+
+# Ошибки связи с сервером. Ошибки самого события (нет файла, отказ сервера) сюда не относятся
+OUTAGE_ERRORS: tuple = (TTransportException, ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError)
+
+
+def _claim(path: Path) -> Optional[int]:
+    """Lock the segment for this process, return descriptor holding the lock or None if it is taken"""
+
+    try:
+        fd: int = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # сегмент мог быть удалён процессом, который отпустил блокировку
+        if os.fstat(fd).st_nlink:
+            return fd
+    except BlockingIOError:
+        pass
+    os.close(fd)
+    return None
+
+
+class Outbox:
+    """Store-and-forward of events while PushAPI server of a tenant is unreachable
+
+    A connection error switches the tenant offline: its events are written
+    to spool segments instead of being sent. The outbox thread probes the
+    server every probe_interval seconds. Once it answers, stored segments
+    are replayed in order of their creation and only while no live delivery
+    waits for a pool connection. Until they are all sent the tenant is
+    draining: live events are still stored behind them, so an event never
+    overtakes an earlier one of the same key. Replay runs at drain_rate plus
+    one event per live event stored meanwhile, the server gets no more than
+    live traffic and drain_rate. A segment is deleted once all its events
+    are sent, the position in a partly replayed one is kept in <segment>.pos.
+
+    Segments are <path>/<tenant>/<created>-<pid>.spool, the one being
+    written ends with .open. Writers and replayers hold flock on their
+    segments, so prefork workers share the directory and segments left by
+    a crashed process are sealed and replayed by any other.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            send: Callable,
+            report: Optional[Callable] = None,
+            segment_size: int = 64 * 1024 * 1024,
+            drain_rate: float = 20,
+            probe_interval: float = 5
+    ):
+        self.path: Path = Path(path)
+        self.send = send
+        self.report = report
+        self.segment_size: int = segment_size
+        self.probe_interval: float = probe_interval
+        self._bucket = TokenBucket(drain_rate, 1)
+        # время следующей проверки сервера по недоступным арендаторам
+        self._offline: Dict[str, float] = {}
+        # доступные арендаторы с накопленными сегментами и число живых событий, записанных за ними
+        self._draining: Dict[str, int] = {}
+        self._writers: Dict[str, Tuple[SpoolWriter, Path]] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def deliver(self, event, tenant: Optional[str] = None, meta: Optional[dict] = None):
+        """Send event, while the server of the tenant is unreachable store it instead and return None"""
+
+        name: str = get_tenant(tenant).name
+        # пока накопленные события не отправлены, новые встают за ними
+        if (name in self._offline or name in self._draining) and self.store(event, name, meta, held=True):
+            return None
+        try:
+            return self.send(event, name, meta)
+        except OUTAGE_ERRORS as err:
+            self._go_offline(name, err)
+        self.store(event, name, meta)
+        return None
+
+    def store(self, event, tenant: str, meta: Optional[dict] = None, held: bool = False) -> bool:
+        """Write event with its data streams to the current segment of the tenant
+
+        With held set the event is written only if the tenant is still offline or draining,
+        False is returned otherwise.
+        """
+
+        evt = TrafficMonitor.make_event(event)
+        with self._lock:
+            if held and tenant not in self._offline and tenant not in self._draining:
+                return False
+            if tenant in self._draining:
+                self._draining[tenant] += 1
+            writer, _ = self._writer(tenant)
+            writer.write(evt, meta)
+            writer.flush()
+            if writer.tell() >= self.segment_size:
+                self._seal(tenant)
+        metrics.OUTBOX_SPOOLED.inc()
+        return True
+
+    def _writer(self, tenant: str) -> Tuple[SpoolWriter, Path]:
+        if tenant not in self._writers:
+            directory: Path = self.path / tenant
+            directory.mkdir(parents=True, exist_ok=True)
+            name: str = f'{time.time_ns():020d}-{os.getpid()}'
+            writer = SpoolWriter(str(directory / f'{name}.new'), settings.STREAM_CHUNK_SIZE)
+            fcntl.flock(writer.fileno(), fcntl.LOCK_EX)
+            # другие процессы видят сегмент только под блокировкой, иначе приняли бы его за брошенный
+            path: Path = directory / f'{name}.open'
+            os.replace(writer.path, path)
+            self._writers[tenant] = (writer, path)
+        return self._writers[tenant]
+
+    def _seal(self, tenant: str) -> None:
+        """Close current segment of the tenant so that it can be replayed, lock must be held"""
+
+        if tenant in self._writers:
+            writer, path = self._writers.pop(tenant)
+            os.replace(path, path.with_suffix('.spool'))
+            writer.close()
+
+    def _go_offline(self, tenant: str, err: Exception) -> None:
+        with self._lock:
+            if tenant in self._offline:
+                return
+            self._offline[tenant] = time.monotonic() + self.probe_interval
+        logger.error(f"PushAPI server of tenant [{tenant}] is unreachable ({err!r}), events are stored on disk")
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self._probe()
+                busy: bool = self._drain()
+            except Exception as err:
+                logger.exception(f"Outbox failed: {err}")
+                busy = False
+            if not busy:
+                self._stopping.wait(1)
+
+    def _probe(self) -> None:
+        now: float = time.monotonic()
+        for tenant, probe_at in list(self._offline.items()):
+            if probe_at > now:
+                continue
+            pool = get_pool(get_tenant(tenant))
+            try:
+                with pool.connection(self.probe_interval) as client:
+                    check_server(client, pool.creds)
+            except Exception as err:
+                logger.debug(f"PushAPI server of tenant [{tenant}] is still unreachable: {err!r}")
+                self._offline[tenant] = now + self.probe_interval
+                continue
+            with self._lock:
+                del self._offline[tenant]
+                self._draining.setdefault(tenant, 0)
+            logger.warning(f"PushAPI server of tenant [{tenant}] is reachable again, sending stored events")
+
+    def _drain(self) -> bool:
+        """Replay segments of reachable tenants, return True if any was taken"""
+
+        if not self.path.exists():
+            self._drained()
+            return False
+        busy: bool = False
+        tenants: dict = get_tenants()
+        for directory in sorted(self.path.iterdir()):
+            tenant: str = directory.name
+            if tenant in self._offline or tenant not in tenants or not directory.is_dir():
+                continue
+            with self._lock:
+                # событие могло быть записано, пока сервер проверялся
+                self._seal(tenant)
+            self._recover(directory)
+            segments: list = sorted(directory.glob('*.spool'))
+            if segments:
+                with self._lock:
+                    # сегменты прошлого запуска тоже отправляются раньше новых событий
+                    self._draining.setdefault(tenant, 0)
+            for segment in segments:
+                if tenant in self._offline or self._stopping.is_set():
+                    break
+                busy = self._replay(tenant, segment) or busy
+        self._drained()
+        return busy
+
+    def _drained(self) -> None:
+        """Send live events of tenants without stored segments directly again"""
+
+        with self._lock:
+            for tenant in list(self._draining):
+                directory: Path = self.path / tenant
+                # пишущийся сегмент этого или другого процесса тоже ещё не отправлен
+                if tenant in self._writers or any(directory.glob('*.spool')) or any(directory.glob('*.open')):
+                    continue
+                del self._draining[tenant]
+                logger.warning(f"Stored events of tenant [{tenant}] are sent, live events are sent directly")
+
+    @staticmethod
+    def _recover(directory: Path) -> None:
+        """Seal segments whose writer process has exited"""
+
+        for path in directory.glob('*.open'):
+            fd: Optional[int] = _claim(path)
+            if fd is None:
+                continue
+            try:
+                os.replace(path, path.with_suffix('.spool'))
+                logger.warning(f"Segment {path.name} of an exited process is sealed for replay")
+            finally:
+                os.close(fd)
+
+    def _replay(self, tenant: str, segment: Path) -> bool:
+        fd: Optional[int] = _claim(segment)
+        if fd is None:
+            return False
+        position: Path = segment.with_suffix('.pos')
+        try:
+            start: int = int(position.read_text()) if position.exists() else 0
+            for spooled in SpoolReader(str(segment), start):
+                if not self._wait_turn(tenant):
+                    return True
+                try:
+                    guid = self.send(spooled.event, tenant, spooled.meta, replayed=True)
+                except OUTAGE_ERRORS as err:
+                    self._go_offline(tenant, err)
+                    return True
+                except Exception as err:
+                    logger.error(f"Stored event {segment.name}:{spooled.offset} dropped: {err}")
+                    self._report(spooled.meta, None, err)
+                else:
+                    metrics.OUTBOX_REPLAYED.inc()
+                    self._report(spooled.meta, guid, None)
+                temporary: Path = position.with_suffix('.tmp')
+                temporary.write_text(str(spooled.end))
+                os.replace(temporary, position)
+        except SpoolError as err:
+            logger.error(f"{err}, segment is put aside")
+            os.replace(segment, segment.with_suffix('.damaged'))
+            return True
+        else:
+            # все события сегмента отправлены, он больше не нужен
+            segment.unlink()
+            position.unlink(missing_ok=True)
+            logger.debug(f"Segment {segment.name} of tenant [{tenant}] is replayed")
+            return True
+        finally:
+            os.close(fd)
+
+    def _wait_turn(self, tenant: str) -> bool:
+        """Wait until a stored event may be sent, return False if replay must stop"""
+
+        pool = get_pool(get_tenant(tenant))
+        # живые события не ждут накопленных: пока они ждут соединения пула, повтор стоит
+        while pool.stats()['waiting']:
+            if self._stopping.wait(0.1):
+                return False
+        with self._lock:
+            # живое событие, записанное за накопленными, было бы отправлено сразу: его место отдаётся повтору
+            released: bool = self._draining.get(tenant, 0) > 0
+            if released:
+                self._draining[tenant] -= 1
+        if not released:
+            self._bucket.acquire()
+        return tenant not in self._offline and not self._stopping.is_set()
+
+    def _report(self, meta: Optional[dict], guid, error: Optional[Exception]) -> None:
+        if self.report is None or not meta:
+            return
+        try:
+            self.report(meta, guid, error)
+        except Exception as err:
+            logger.exception(f"Reporting replayed event failed: {err}")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stop replay and seal current segments, they are replayed after restart"""
+
+        self._stopping.set()
+        self._thread.join(timeout)
+        with self._lock:
+            for tenant in list(self._writers):
+                self._seal(tenant)
+
+    def health(self) -> dict:
+        segments: int = sum(1 for _ in self.path.glob('*/*.spool')) if self.path.exists() else 0
+        return {
+            'alive': self._thread.is_alive() or self._stopping.is_set(),
+            # недоступный сервер не мешает принимать вебхуки, они копятся на диске
+            'offline': sorted(self._offline),
+            'draining': sorted(self._draining),
+            'segments': segments + len(self._writers),
+        }
+
+
+_outbox: Optional[Outbox] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox(send: Callable, report: Optional[Callable] = None) -> Optional[Outbox]:
+    """Return outbox of the process or None when store-and-forward is disabled
+
+    send(event, tenant, meta, replayed=False) returns guid of the delivered event, replayed is set
+    for stored events. report(meta, guid, error) is called once a stored event is replayed or dropped.
+    """
+
+    global _outbox
+    if not settings.SPOOL_ENABLED:
+        return None
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(
+                settings.SPOOL_DIR or str(logs_dir_full_path / 'spool'), send, report,
+                segment_size=settings.SPOOL_SEGMENT_SIZE, drain_rate=settings.SPOOL_DRAIN_RATE,
+                probe_interval=settings.SPOOL_PROBE_INTERVAL
+            )
+    return _outbox
+
+
+def close_outbox(timeout: Optional[float] = None) -> None:
+    global _outbox
+    with _outbox_lock:
+        outbox, _outbox = _outbox, None
+    if outbox is not None:
+        outbox.close(timeout)
+
+
+def _forget_outbox() -> None:
+    """Outbox thread is not inherited by a forked worker, it starts its own"""
+
+    global _outbox
+    _outbox = None
+
+
+os.register_at_fork(after_in_child=_forget_outbox)
@@ -0,0 +1,74 @@
+import os
+from typing import Optional
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import logger, settings
+
+
+class WebDAVClient:
+    """Download files from OwnCloud over WebDAV using a pooled HTTP session"""
+
+    def __init__(
+            self,
+            host: str,
+            user: str = '',
+            password: str = '',
+            webdav_path: str = '/remote.php/webdav',
+            pool_size: int = 10,
+            timeout: int = 30
+    ):
+        self.base_url: str = f"{host.rstrip('/')}/{webdav_path.strip('/')}".rstrip('/')
+        self.timeout: int = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if user:
+            self.session.auth = (user, password)
+
+    def get_url(self, path: str) -> str:
+        return f"{self.base_url}/{quote(path.lstrip('/'))}"
+
+    def open(self, path: str) -> requests.Response:
+        """Start file download, the body is read from response.raw by the caller"""
+
+        url: str = self.get_url(path)
+        logger.debug(f"Downloading [{url}]")
+        # тело читается через readinto(), а urllib3 не распаковывает в него сжатый ответ
+        response = self.session.get(url, stream=True, timeout=self.timeout, headers={'Accept-Encoding': 'identity'})
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response
+
+
+_client: Optional[WebDAVClient] = None
+
+
+def get_webdav_client() -> WebDAVClient:
+    """Return WebDAV client shared by all requests of the process"""
+
+    global _client
+    if _client is None:
+        _client = WebDAVClient(
+            host=settings.OWNCLOUD_HOST, user=settings.OWNCLOUD_USER,
+            password=settings.OWNCLOUD_PASSWORD, webdav_path=settings.OWNCLOUD_WEBDAV_PATH,
+            pool_size=settings.HTTP_POOL_SIZE, timeout=settings.HTTP_TIMEOUT
+        )
+    return _client
+
+
+def _forget_client() -> None:
+    """Forked worker opens its own HTTP connections"""
+
+    global _client
+    _client = None
+
+
+os.register_at_fork(after_in_child=_forget_client)
@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from config import logger, settings
+from pushapi import ttypes
+from pushapi import pushapi_wrappers as wrappers
+from sender import check_server
+from tenants import Tenant, get_tenant
+
+
+class Connection:
+    """Verified PushAPI client"""
+
+    __slots__ = ('client', 'released_at')
+
+    def __init__(self, client):
+        self.client = client
+        self.released_at: float = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.client._oprot.trans.close()
+        except Exception as err:
+            logger.debug(f"Closing connection: {err}")
+
+
+class ConnectionPool:
+    """Pool of PushAPI connections verified with GetVersion and VerifyCredentials"""
+
+    def __init__(self, host: str, port: int, name: str, token: str, size: int = 4, idle_timeout: int = 300):
+        self.host: str = host
+        self.port: int = port
+        self.creds = ttypes.Credentials(name, token)
+        self.size: int = size
+        self.idle_timeout: int = idle_timeout
+        self.last_version_check: Optional[float] = None
+        self.ready: bool = False
+        self._idle: List[Connection] = []
+        self._opened: int = 0
+        self._waiting: int = 0
+        self._lock = threading.Condition()
+
+    def _connect(self) -> Connection:
+        client = wrappers.make_client(self.host, self.port)
+        try:
+            check_server(client, self.creds)
+        except Exception:
+            Connection(client).close()
+            raise
+        self.last_version_check = time.time()
+        self.ready = True
+        return Connection(client)
+
+    def acquire(self, timeout: Optional[float] = None) -> Connection:
+        """Return idle connection, open a new one if the pool is not full, otherwise wait"""
+
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                while self._idle:
+                    connection: Connection = self._idle.pop()
+                    if time.monotonic() - connection.released_at < self.idle_timeout:
+                        return connection
+                    self._opened -= 1
+                    connection.close()
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                remaining: Optional[float] = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No free PushAPI connection in {timeout} s")
+                self._waiting += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, connection: Connection, broken: bool = False) -> None:
+        """Return connection to the pool, broken connections are closed"""
+
+        with self._lock:
+            if broken:
+                self._opened -= 1
+                connection.close()
+            else:
+                connection.released_at = time.monotonic()
+                self._idle.append(connection)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator:
+        """Acquire a client for one delivery, connection is dropped if delivery fails"""
+
+        connection: Connection = self.acquire(timeout)
+        try:
+            yield connection.client
+        except Exception:
+            self.release(connection, broken=True)
+            raise
+        self.release(connection)
+
+    def warm_up(self, count: int) -> int:
+        """Open and verify up to count connections in parallel, return number of opened"""
+
+        count = min(count, self.size)
+        if count <= 0:
+            self.ready = True
+            return 0
+        logger.debug(f"Warming up {count} PushAPI connections...")
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures: list = [executor.submit(self.acquire, settings.WARMUP_TIMEOUT) for _ in range(count)]
+            connections: list = []
+            for future in futures:
+                try:
+                    connections.append(future.result())
+                except Exception as err:
+                    logger.error(f"PushAPI connection warm-up failed: {err}")
+        for connection in connections:
+            self.release(connection)
+        logger.debug(f"Warming up PushAPI connections: {len(connections)}/{count} OK")
+        return len(connections)
+
+    def retry_warm_up(self, count: int, interval: float) -> threading.Thread:
+        """Repeat warm-up in a background thread every interval seconds until a connection is verified"""
+
+        def run() -> None:
+            # живая доставка тоже делает пул готовым, тогда повторять прогрев незачем
+            while not self.ready:
+                time.sleep(interval)
+                if not self.ready:
+                    self.warm_up(count)
+            logger.warning(f"PushAPI server [{self.host}:{self.port}] is reachable, connection pool is ready")
+
+        thread = threading.Thread(target=run, name='pool-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def close(self) -> None:
+        with self._lock:
+            while self._idle:
+                self._opened -= 1
+                self._idle.pop().close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': self.size,
+                'opened': self._opened,
+                'idle': len(self._idle),
+                'busy': self._opened - len(self._idle),
+                'waiting': self._waiting,
+            }
+
+    def health(self) -> dict:
+        """Pool state for readiness probe, the server itself is not contacted"""
+
+        state: dict = self.stats()
+        state['last_version_check'] = self.last_version_check
+        # пул не готов, пока не прогрет, и перегружен, если запросы ждут свободного соединения
+        state['ready'] = self.ready and not state['waiting']
+        return state
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(tenant: Optional[Tenant] = None) -> ConnectionPool:
+    """Return PushAPI connection pool of the tenant in this process, it is created on first use"""
+
+    tenant = tenant or get_tenant()
+    with _pool_lock:
+        if tenant.name not in _pools:
+            _pools[tenant.name] = ConnectionPool(
+                host=tenant.host, port=tenant.port,
+                name=tenant.company_name, token=tenant.token,
+                size=settings.PUSHAPI_POOL_SIZE, idle_timeout=settings.PUSHAPI_IDLE_TIMEOUT
+            )
+        return _pools[tenant.name]
+
+
+def get_pools() -> Dict[str, ConnectionPool]:
+    with _pool_lock:
+        return dict(_pools)
+
+
+def pools_health() -> dict:
+    """Health of pools of all tenants, the instance is ready when every pool is"""
+
+    states: dict = {name: pool.health() for name, pool in get_pools().items()}
+    return {'ready': all(state['ready'] for state in states.values()), 'tenants': states}
+
+
+def _forget_pool() -> None:
+    """Forked worker must not use connections opened by the parent process"""
+
+    _pools.clear()
+
+
+os.register_at_fork(after_in_child=_forget_pool)
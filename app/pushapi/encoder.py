@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''Прямое кодирование аргументов BeginEvent в бинарный протокол Thrift.
+
+Формирует те же байты, что и сгенерированные методы write() при TBinaryProtocol,
+но без построения промежуточных трифтовых структур (Event, Attribute, ChatMessage, BeginEvent_args).
+'''
+
+from functools import lru_cache
+from struct import Struct
+
+from thrift.Thrift import TMessageType, TType
+
+from .ttypes import IdentityItemType
+
+_FIELD = Struct('!bh')
+_I32 = Struct('!i')
+_LIST = Struct('!bi')
+_STOP = b'\x00'
+_EMPTY_LISTS = (
+    _FIELD.pack(TType.LIST, 3) + _LIST.pack(TType.STRUCT, 0) +
+    _FIELD.pack(TType.LIST, 4) + _LIST.pack(TType.STRUCT, 0)
+)
+
+
+class EncodedEvent(object):
+    '''Закодированные аргументы BeginEvent и потоки данных события.'''
+    __slots__ = ('payload', 'evt_data')
+
+    def __init__(self, payload, evt_data):
+        '''
+        :param payload: закодированные BeginEvent_args
+        :type payload: bytes
+        :param evt_data: данные события, передаваемые потоками после BeginEvent
+        :type evt_data: list (items type pushapi.EventData)
+        '''
+        self.payload = payload
+        self.evt_data = evt_data
+
+
+class Fragment(object):
+    '''Заранее закодированная последовательность элементов списка.'''
+    __slots__ = ('data', 'count')
+
+    def __init__(self, data, count):
+        '''
+        :param data: закодированные элементы
+        :type data: bytes
+        :param count: количество элементов
+        :type count: int
+        '''
+        self.data = data
+        self.count = count
+
+
+def _write_i32(buf, fid, value):
+    buf += _FIELD.pack(TType.I32, fid)
+    buf += _I32.pack(value)
+
+
+def _write_string(buf, fid, value):
+    data = value.encode('utf-8')
+    buf += _FIELD.pack(TType.STRING, fid)
+    buf += _I32.pack(len(data))
+    buf += data
+
+
+def _write_attribute(buf, name, value):
+    '''Структура pushapi.Attribute без заголовка поля.'''
+    if name is not None:
+        _write_string(buf, 1, name)
+    if value is not None:
+        _write_string(buf, 2, value)
+    buf += _STOP
+
+
+def _write_attribute_list(buf, fid, attrs):
+    '''Список атрибутов, заданных объектами pushapi.Attribute.'''
+    buf += _FIELD.pack(TType.LIST, fid)
+    buf += _LIST.pack(TType.STRUCT, len(attrs))
+    for attr in attrs:
+        _write_attribute(buf, attr.name, attr.value)
+
+
+def _write_attribute_pairs(buf, fid, items):
+    '''Список атрибутов, заданных парами (имя, значение) и фрагментами Fragment.'''
+    count = 0
+    for item in items:
+        count += item.count if isinstance(item, Fragment) else 1
+    buf += _FIELD.pack(TType.LIST, fid)
+    buf += _LIST.pack(TType.STRUCT, count)
+    for item in items:
+        if isinstance(item, Fragment):
+            buf += item.data
+        else:
+            _write_attribute(buf, item[0], item[1])
+
+
+def _write_identity(buf, identity):
+    '''Структура pushapi.Identity без заголовка поля.'''
+    if identity.identity_id is not None:
+        _write_i32(buf, 1, identity.identity_id)
+    if identity.identity_type is not None:
+        _write_i32(buf, 2, identity.identity_type)
+    if identity.identity_contacts is not None:
+        _write_attribute_list(buf, 3, identity.identity_contacts)
+    if identity.identity_attributes is not None:
+        _write_attribute_list(buf, 4, identity.identity_attributes)
+    contacts = identity.identity_contacts_with_meta
+    if contacts is not None:
+        buf += _FIELD.pack(TType.LIST, 5)
+        buf += _LIST.pack(TType.STRUCT, len(contacts))
+        for contact in contacts:
+            if contact.contact is not None:
+                buf += _FIELD.pack(TType.STRUCT, 1)
+                _write_attribute(buf, contact.contact.name, contact.contact.value)
+            if contact.meta is not None:
+                _write_string(buf, 2, contact.meta)
+            buf += _STOP
+    buf += _STOP
+
+
+def _write_person(buf, identity_id, contact_type, address):
+    '''Структура pushapi.Identity персоны с одним контактом, как у wrappers.PersonIdentity.'''
+    _write_i32(buf, 1, identity_id)
+    _write_i32(buf, 2, IdentityItemType.kPerson)
+    # устаревшие контакты и атрибуты - пустые списки
+    buf += _EMPTY_LISTS
+    buf += _FIELD.pack(TType.LIST, 5)
+    buf += _LIST.pack(TType.STRUCT, 1)
+    buf += _FIELD.pack(TType.STRUCT, 1)
+    _write_attribute(buf, contact_type, address)
+    buf += _STOP
+    buf += _STOP
+
+
+def _write_identity_list(buf, fid, identities):
+    '''Список идентификаций: объекты pushapi.Identity или кортежи персон (identity_id, contact_type, address).'''
+    buf += _FIELD.pack(TType.LIST, fid)
+    buf += _LIST.pack(TType.STRUCT, len(identities))
+    for identity in identities:
+        if isinstance(identity, tuple):
+            _write_person(buf, *identity)
+        else:
+            _write_identity(buf, identity)
+
+
+def _write_event_data_list(buf, fid, evt_data):
+    buf += _FIELD.pack(TType.LIST, fid)
+    buf += _LIST.pack(TType.STRUCT, len(evt_data))
+    for data in evt_data:
+        if data.data_id is not None:
+            _write_i32(buf, 1, data.data_id)
+        if data.data_attributes is not None:
+            _write_attribute_list(buf, 2, data.data_attributes)
+        buf += _STOP
+
+
+def _write_message_list(buf, fid, messages):
+    '''Список сообщений чата, заданных кортежами (sender_id, sent_time, text, data_id).'''
+    buf += _FIELD.pack(TType.LIST, fid)
+    buf += _LIST.pack(TType.STRUCT, len(messages))
+    for sender_id, sent_time, text, data_id in messages:
+        if sender_id is not None:
+            _write_i32(buf, 1, sender_id)
+        if sent_time is not None:
+            _write_string(buf, 2, sent_time)
+        if text is not None:
+            _write_string(buf, 3, text)
+        if data_id is not None:
+            _write_i32(buf, 4, data_id)
+        buf += _STOP
+
+
+def encode_begin_event(evt_class, service, attributes, senders, receivers, evt_data, messages, creds):
+    '''Кодирует BeginEvent_args так же, как BeginEvent_args.write() с TBinaryProtocol.
+    :param evt_class: класс события
+    :type evt_class: pushapi.EventClass
+    :param service: сервис события
+    :type service: str
+    :param attributes: атрибуты события
+    :type attributes: list (items type tuple (name, value) или Fragment)
+    :param senders: отправители
+    :type senders: list (items type pushapi.Identity или tuple (identity_id, contact_type, address))
+    :param receivers: получатели
+    :type receivers: list (items type pushapi.Identity или tuple (identity_id, contact_type, address))
+    :param evt_data: данные события
+    :type evt_data: list (items type pushapi.EventData)
+    :param messages: сообщения чата или None
+    :type messages: list (items type tuple (sender_id, sent_time, text, data_id))
+    :param creds: данные учётной записи
+    :type creds: pushapi.Credentials
+    :return: закодированные аргументы
+    :rtype: bytes
+    '''
+    buf = bytearray()
+    # поле 1: event
+    buf += _FIELD.pack(TType.STRUCT, 1)
+    _write_i32(buf, 1, evt_class)
+    _write_string(buf, 2, service)
+    if attributes is not None:
+        _write_attribute_pairs(buf, 3, attributes)
+    _write_identity_list(buf, 4, senders)
+    _write_identity_list(buf, 5, receivers)
+    _write_event_data_list(buf, 6, evt_data)
+    if messages is not None:
+        _write_message_list(buf, 8, messages)
+    buf += _STOP
+    # поле 2: cred
+    buf += _FIELD.pack(TType.STRUCT, 2)
+    buf += credentials_fragment(creds)
+    buf += _STOP
+    return bytes(buf)
+
+
+# Неизменяемые части кадра (атрибуты сервера перехвата, учётные данные) кодируются один раз.
+# Ключом кэша служат сами значения, поэтому при смене настроек берутся новые фрагменты.
+@lru_cache(maxsize=32)
+def attributes_fragment(pairs):
+    '''Возвращает закодированные атрибуты.
+    :param pairs: атрибуты
+    :type pairs: tuple (items type tuple (name, value))
+    :rtype: Fragment
+    '''
+    buf = bytearray()
+    for name, value in pairs:
+        _write_attribute(buf, name, value)
+    return Fragment(bytes(buf), len(pairs))
+
+
+@lru_cache(maxsize=32)
+def _credentials_struct(company_name, token):
+    buf = bytearray()
+    # Credentials совпадает по раскладке полей с Attribute: 1 - company_name, 2 - token
+    _write_attribute(buf, company_name, token)
+    return bytes(buf)
+
+
+def credentials_fragment(creds):
+    '''Возвращает закодированную структуру pushapi.Credentials.
+    :type creds: pushapi.Credentials
+    :rtype: bytes
+    '''
+    return _credentials_struct(creds.company_name, creds.token)
+
+
+def clear_fragments():
+    '''Сбрасывает кэш закодированных фрагментов.'''
+    attributes_fragment.cache_clear()
+    _credentials_struct.cache_clear()
+
+
+def begin_event(client, payload):
+    '''Вызывает BeginEvent с заранее закодированными аргументами.
+    :param client: клиент PushAPI
+    :type client: EventProcessor.Client
+    :param payload: результат encode_begin_event()
+    :type payload: bytes
+    :return: идентификатор события
+    :rtype: int
+    '''
+    oprot = client._oprot
+    oprot.writeMessageBegin('BeginEvent', TMessageType.CALL, client._seqid)
+    oprot.trans.write(payload)
+    oprot.writeMessageEnd()
+    oprot.trans.flush()
+    return client.recv_BeginEvent()
+
+
+def verify_credentials(client, creds):
+    '''Вызывает VerifyCredentials с заранее закодированными учётными данными.
+    :param client: клиент PushAPI
+    :type client: EventProcessor.Client
+    :type creds: pushapi.Credentials
+    '''
+    oprot = client._oprot
+    oprot.writeMessageBegin('VerifyCredentials', TMessageType.CALL, client._seqid)
+    oprot.trans.write(_FIELD.pack(TType.STRUCT, 1))
+    oprot.trans.write(credentials_fragment(creds))
+    oprot.trans.write(_STOP)
+    oprot.writeMessageEnd()
+    oprot.trans.flush()
+    client.recv_VerifyCredentials()
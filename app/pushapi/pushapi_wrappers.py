@@ -3,15 +3,16 @@
 '''Вспомогательные классы и функции для работы с PushAPI.'''
 
 # common modules
+import time
 from datetime import datetime
 from dateutil.tz import tzlocal # pip install python-dateutil
 
 # apache thrift modules
-from thrift.transport import TSSLSocket, TTransport
+from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
 
 # thrift autogenerated modules
-from . import EventProcessor
+# EventProcessor (клиент и серверный Processor) и TSSLSocket загружаются в make_client() при первом подключении
 from . import ttypes as pushapi
 from . import constants as constants
 
@@ -25,6 +26,9 @@ def make_client(host, port):
     :return: экземпляр класса клиента, подключённый к серверу
     :rtype: EventProcessor.Client
     '''
+    from thrift.transport import TSSLSocket
+    from . import EventProcessor
+
     # Сервер требует подключения по SSL по бинарному протоколу с фреймами
     sock = TSSLSocket.TSSLSocket(host=host, port=port, validate=False)
     transport = TTransport.TFramedTransport(sock)
@@ -33,9 +37,21 @@ def make_client(host, port):
     return EventProcessor.Client(protocol)
 
 
+_local_tz = tzlocal()
+# (секунда, отформатированное время) - время меняется раз в секунду, форматируем его один раз
+_current_datetime_tz = (None, '')
+
+
 def get_current_datetime_tz():
     '''Возвращает текущее время в формате YYYY-MM-DDThh:mm:ss[+-]hh:mm'''
-    return datetime.now(tzlocal()).replace(microsecond=0).isoformat()
+    global _current_datetime_tz
+    second = int(time.time())
+    cached_second, formatted = _current_datetime_tz
+    if second != cached_second:
+        # смещение таймзоны вычисляется для этой секунды, поэтому переход на летнее время учитывается
+        formatted = datetime.fromtimestamp(second, _local_tz).isoformat()
+        _current_datetime_tz = (second, formatted)
+    return formatted
 
 
 def get_next_id():
@@ -306,18 +322,9 @@ class Event(pushapi.Event):
         :param capture_server_fqdn: полное доменное имя сервера перехвата
         :type capture_server_fqdn: str
         '''
-        # Устанавливаем время перехвата, если оно не задано
-        if not capture_date:
-            capture_date = get_current_datetime_tz()
-
-        # обязательные атрибуты
         evt_attribs = [
-            # время перехвата с таймзоной
-            pushapi.Attribute(constants.event_attr_capture_date, capture_date),
-            # IP сервера, на котором произошёл перехват
-            pushapi.Attribute(constants.event_attr_capture_server_ip, capture_server_ip),
-            # имя сервера, на котором произошёл перехват
-            pushapi.Attribute(constants.event_attr_capture_server_fqdn, capture_server_fqdn)
+            pushapi.Attribute(name, value)
+            for name, value in mandatory_attributes(capture_date, capture_server_ip, capture_server_fqdn)
         ]
         if self.evt_attributes is None:
             self.evt_attributes = []
@@ -350,6 +357,25 @@ class Event(pushapi.Event):
             self.add_receivers(receivers)
 
 
+def mandatory_attributes(capture_date=None, capture_server_ip="127.0.0.1", capture_server_fqdn="my_capture_server.example.com"):
+    '''Возвращает обязательные атрибуты события парами (имя, значение).
+    Параметры см. Event.add_mandatory_attributes()
+    :rtype: list (items type tuple)
+    '''
+    # Устанавливаем время перехвата, если оно не задано
+    if not capture_date:
+        capture_date = get_current_datetime_tz()
+
+    return [
+        # время перехвата с таймзоной
+        (constants.event_attr_capture_date, capture_date),
+        # IP сервера, на котором произошёл перехват
+        (constants.event_attr_capture_server_ip, capture_server_ip),
+        # имя сервера, на котором произошёл перехват
+        (constants.event_attr_capture_server_fqdn, capture_server_fqdn)
+    ]
+
+
 def _add_item(vect, item):
     if item is not None:
         vect = [] if vect is None else vect[:]
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import metrics
+from config import logger, settings
+
+EVENTS_WAIT = metrics.histogram('ratelimit_wait_seconds', 'Time spent waiting for rate limit', limit='events')
+BYTES_WAIT = metrics.histogram('ratelimit_wait_seconds', 'Time spent waiting for rate limit', limit='bytes')
+
+
+class TokenBucket:
+    """Token bucket shared by threads of the process
+
+    acquire() never rejects: tokens are taken at once, possibly going into
+    debt, and the caller sleeps until the debt is repaid. Callers are thus
+    served in the order they came and a request larger than the burst still
+    passes, only after a longer wait.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate: float = rate
+        self.burst: float = max(burst, 1)
+        self._tokens: float = self.burst
+        self._updated: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """Take amount tokens, wait while there are not enough, return waited time"""
+
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now: float = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            delay: float = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+_workers: int = 1
+_events: Optional[TokenBucket] = None
+_bytes: Optional[TokenBucket] = None
+_lock = threading.Lock()
+
+
+def init(workers: int) -> None:
+    """Set number of processes sharing the limits, must be called before fork"""
+
+    global _workers, _events, _bytes
+    _workers = max(workers, 1)
+    _events = _bytes = None
+
+
+def _bucket(rate: float) -> TokenBucket:
+    # в режиме prefork у каждого процесса своя корзина, лимит делится поровну между ними
+    rate = rate / _workers
+    return TokenBucket(rate, rate * settings.RATE_LIMIT_BURST)
+
+
+def acquire_event() -> None:
+    """Wait for permission to begin one event"""
+
+    global _events
+    if not settings.RATE_LIMIT_EVENTS:
+        return
+    with _lock:
+        if _events is None:
+            _events = _bucket(settings.RATE_LIMIT_EVENTS)
+    delay: float = _events.acquire()
+    EVENTS_WAIT.observe(delay)
+    if delay > 1:
+        logger.debug(f"Event delayed by rate limit for {delay:.3f} s")
+
+
+def acquire_bytes(amount: int) -> None:
+    """Wait for permission to send amount bytes of stream data"""
+
+    global _bytes
+    if not settings.RATE_LIMIT_BYTES:
+        return
+    with _lock:
+        if _bytes is None:
+            _bytes = _bucket(settings.RATE_LIMIT_BYTES)
+    BYTES_WAIT.observe(_bytes.acquire(amount))
+
+
+def _forget_buckets() -> None:
+    """Forked worker starts with full buckets of its own"""
+
+    global _events, _bytes
+    _events = _bytes = None
+
+
+os.register_at_fork(after_in_child=_forget_buckets)
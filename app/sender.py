@@ -2,10 +2,17 @@
 # pylint: disable=import-error
 from __future__ import print_function
 
+import os
+
 import pushapi.constants as constants
 import pushapi.ttypes as pushapi
-from config import logger
+import metrics
+import ratelimit
+from config import logger, settings
+from event_creator import SkypePerson
+from pushapi import encoder
 from pushapi import pushapi_wrappers as wrappers
+from streams import StreamDigest, get_mimetype, read_ahead
 
 
 class EventDataFromString(wrappers.EventData):
@@ -15,17 +22,83 @@ class EventDataFromString(wrappers.EventData):
         self.content = content
         super(EventDataFromString, self).__init__(attrs)
 
+    def iter_chunks(self, chunk_size):
+        """Возвращает содержимое по частям не более chunk_size байт."""
+        content = self.content
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        view = memoryview(content)
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size]
+
 
-class EventDataFromFile(EventDataFromString):
+class EventDataFromFile(wrappers.EventData):
     """Данные события с подгрузкой из файла."""
 
-    # В этом примере реализован простейший алгоритм: файл читается целиком.
-    # Возможна реализация чтения и отправка файла по чанкам
+    # Файл читается и отправляется по чанкам, целиком в память не загружается.
+    # Следующие чанки читаются в отдельном потоке, пока текущий передаётся на сервер.
     def __init__(self, filename, attrs=None):
-        with open(filename) as stm:
-            content = stm.read()
-        logger.debug(f"File content: \n{content}\n")
-        super(EventDataFromFile, self).__init__(content, attrs)
+        self.filename = filename
+        super(EventDataFromFile, self).__init__(attrs)
+
+    def iter_chunks(self, chunk_size):
+        with open(self.filename, 'rb', buffering=0) as stm:
+            yield from read_ahead(stm, chunk_size, settings.STREAM_READ_AHEAD)
+
+
+class EventDataFromWebDAV(wrappers.EventData):
+    """Данные события с загрузкой из OwnCloud по WebDAV.
+
+    Тело ответа передаётся в SendStreamData по чанкам, без сохранения на диск.
+    """
+
+    def __init__(self, path, attrs=None, client=None):
+        # requests загружается только при первой передаче файла по WebDAV
+        from owncloud import get_webdav_client
+
+        self.path = path
+        self.client = client or get_webdav_client()
+        super(EventDataFromWebDAV, self).__init__(attrs)
+
+    def iter_chunks(self, chunk_size):
+        with self.client.open(self.path) as response:
+            yield from read_ahead(response.raw, chunk_size, settings.STREAM_READ_AHEAD)
+
+
+def make_event_data(filename, attrs=None):
+    """Возвращает данные события для файла из источника, заданного в FILE_SOURCE.
+    К атрибутам данных добавляются mimetype (по расширению файла) и, для локального файла, размер.
+    Контрольные суммы алгоритмов STREAM_DIGESTS (по умолчанию sha256) сохраняются в поле digest данных.
+    :param attrs: атрибуты данных парами (имя, значение)
+    """
+    attrs = [pushapi.Attribute(name, value) for name, value in attrs or ()]
+    names = {attr.name for attr in attrs}
+    if constants.data_attr_mimetype not in names:
+        attrs.append(pushapi.Attribute(constants.data_attr_mimetype, get_mimetype(filename)))
+    if settings.FILE_SOURCE == 'webdav':
+        return EventDataFromWebDAV(filename, attrs)
+    if constants.data_attr_size not in names:
+        attrs.append(pushapi.Attribute(constants.data_attr_size, str(os.path.getsize(filename))))
+    return EventDataFromFile(filename, attrs)
+
+
+def check_server(client, creds):
+    """Проверка версии сервера PushAPI и данных учётной записи.
+    :param client: клиент PushAPI
+    :type client: EventProcessor.Client
+    :param creds: данные учётной записи
+    :type creds: pushapi.Credentials
+    """
+    logger.debug(f"Checking server version...")
+    client_version = constants.pushapi_version
+    server_version = client.GetVersion()
+    if server_version < client_version:
+        raise RuntimeError("incompatible version: client: %d, server: %d" % (client_version, server_version))
+    if settings.DIRECT_ENCODING:
+        encoder.verify_credentials(client, creds)
+    else:
+        client.VerifyCredentials(creds)
+    logger.debug(f"Checking server version: OK")
 
 
 class TrafficMonitor(object):
@@ -34,6 +107,8 @@ class TrafficMonitor(object):
         event - экземпляр события, которое будет отправлено
         _creds - данные учётной записи (имя компании, токен). Тип: pushapi.Credentials
         _client - клиент PushAPI. Тип: EventProcessor.Client
+        _verified - соединение уже проверено (получено из пула соединений)
+        streams - размер и контрольные суммы переданных потоков по data_id. Тип: dict из streams.StreamDigest
     """
 
     def __init__(
@@ -42,77 +117,113 @@ class TrafficMonitor(object):
             host: str,
             port: int,
             name: str,
-            token: str
+            token: str,
+            client=None
     ):
-        logger.debug(f"Connecting to [{host}:{port}]")
-        self._client = wrappers.make_client(host, port)
+        self._verified = client is not None
+        if client is None:
+            logger.debug(f"Connecting to [{host}:{port}]")
+            client = wrappers.make_client(host, port)
+        self._client = client
         logger.debug(f"Check credentials: [{name}] : [{token}]")
         self._creds = pushapi.Credentials(name, token)
 
         self._event = event
+        self.streams = {}
 
     def send_message(self):
-        """Функция проверяет соединение с сервером и отсылает тестовые события."""
-        # проверка версии и токена
-        self._check_server()
+        """Функция проверяет соединение с сервером и отсылает тестовые события.
+        :return: guid события в базе данных сервера
+        """
+        # проверка версии и токена, соединения из пула уже проверены
+        if not self._verified:
+            self._check_server()
         # передача на сервер PushAPI всех тестовых событий
-        self._run_demo_event(self._event)
+        return self._run_demo_event(self._event)
 
     def _check_server(self):
         """Проверка версии сервера PushAPI и данных учётной записи."""
-
-        logger.debug(f"Checking server version...")
-        client_version = constants.pushapi_version
-        server_version = self._client.GetVersion()
-        if server_version < client_version:
-            raise RuntimeError("incompatible version: client: %d, server: %d" % (client_version, server_version))
-        self._client.VerifyCredentials(self._creds)
-        logger.debug(f"Checking server version: OK")
+        check_server(self._client, self._creds)
 
     def _run_demo_event(self, event):
         """Формирование и отправка примера события на сервер.
         :param demo_data: данные примера
         """
-        # формируем трифтовую структуру события
-        evt = self.make_event(event)
+        # событие из спула уже построено, его потоки читаются из файла спула
+        if isinstance(event, pushapi.Event):
+            evt = event
+        # формируем трифтовую структуру события или сразу её бинарное представление
+        elif settings.DIRECT_ENCODING:
+            evt = self.encode_event(event)
+        else:
+            evt = self.make_event(event)
         # отсылаем на сервер
         guid = self._send_to_server(evt)
         # сообщаем о выполнении
-        logger.debug("%s event successfully sent to PushAPI server with guid %s" % (event.name, guid))
+        logger.debug("%s event successfully sent to PushAPI server with guid %s" % (getattr(event, 'name', 'Stored'), guid))
+        return guid
 
     def _send_to_server(self, evt):
         """Передача на сервер события.
         :param evt: полностью сформированное событие
-        :type evt: pushapi.Event
+        :type evt: pushapi.Event или encoder.EncodedEvent
         """
         logger.debug(f"Sending event to server...")
-        event_id = self._client.BeginEvent(evt, self._creds)
+        with metrics.DELIVERY_SECONDS.time():
+            try:
+                guid = self._send_event(evt)
+            except Exception:
+                metrics.DELIVERY_ERRORS.inc()
+                raise
+        metrics.EVENTS_DELIVERED.inc()
+
+        logger.debug(f"Sending event to server: OK")
+        return guid
+
+    def _send_event(self, evt):
+        with metrics.RPC_SECONDS['BeginEvent'].time():
+            if isinstance(evt, encoder.EncodedEvent):
+                event_id = encoder.begin_event(self._client, evt.payload)
+            else:
+                event_id = self._client.BeginEvent(evt, self._creds)
         abort_flag = False
         try:
             for data in evt.evt_data:
                 stream_id = self._client.BeginStream(event_id, data.data_id)
+                # контрольные суммы (если заданы) считаются по тем же чанкам, что уходят на сервер
+                data.digest = StreamDigest(settings.STREAM_DIGESTS.split(','))
                 try:
-                    self._client.SendStreamData(event_id, stream_id, data.content)
+                    for chunk in data.iter_chunks(settings.STREAM_CHUNK_SIZE):
+                        data.digest.update(chunk)
+                        ratelimit.acquire_bytes(len(chunk))
+                        with metrics.RPC_SECONDS['SendStreamData'].time():
+                            self._client.SendStreamData(event_id, stream_id, chunk)
                 finally:
                     self._client.EndStream(event_id, stream_id)
+                metrics.BYTES_STREAMED.inc(data.digest.size)
+                self.streams[data.data_id] = data.digest
+                if settings.STREAM_DIGESTS:
+                    logger.debug(f"Stream {data.data_id} sent: {data.digest.size} bytes, {data.digest.hexdigests()}")
             guid = self._client.GetEventDatabaseId(event_id)
         except:
             abort_flag = True  # ошибка, завершаем событие с флагом abort
             raise
         finally:
-            self._client.EndEvent(event_id, abort_flag)
-
-        logger.debug(f"Sending event to server: OK")
+            with metrics.RPC_SECONDS['EndEvent'].time():
+                self._client.EndEvent(event_id, abort_flag)
         return guid
 
-    def make_event(self, data):
+    @classmethod
+    def make_event(cls, data):
         """По описанию примера строит объект Event"""
         evt = wrappers.Event(data.evt_class, data.service)
-        self.make_event_attributes(evt, data.name)  # атрибуты события
-        evt.add_identities(data.senders, data.receivers)  # добавляем отправителей и получателей
+        cls.make_event_attributes(evt, data.name)  # атрибуты события
+        # добавляем отправителей и получателей
+        evt.add_identities([SkypePerson(sender) for sender in data.senders],
+                           [SkypePerson(receiver) for receiver in data.receivers])
         # добавляем потоки данных, если они заданы
         if data.data_file:
-            evt.evt_data = [EventDataFromFile(data.data_file, data.data_attrs)]
+            evt.evt_data = [make_event_data(data.data_file, data.data_attrs)]
         # добавляем сообщения чата, если они заданы
         if data.messages:
             evt.evt_messages = []
@@ -120,9 +231,62 @@ class TrafficMonitor(object):
                 assert msg.sender_no < len(evt.evt_senders)  # проверим корректность - такой отправитель есть в списке
                 sender_id = evt.evt_senders[msg.sender_no].identity_id  # и получим его идентификатор
                 # добавим сообщение к списку
-                evt.evt_messages.append(wrappers.ChatMessage(sender_id, msg.sent_time, msg.text))
+                evt.evt_messages.append(cls.make_chat_message(evt, sender_id, msg))
         return evt
 
+    def encode_event(self, data):
+        """По описанию примера сразу кодирует аргументы BeginEvent, минуя объект Event.
+        Результат побайтно совпадает с BeginEvent_args(make_event(data), creds).write().
+        """
+        # отправители и получатели: (identity_id, тип контакта, контакт)
+        senders = [(wrappers.get_next_id(), constants.contact_type_skype, sender) for sender in data.senders]
+        receivers = [(wrappers.get_next_id(), constants.contact_type_skype, receiver) for receiver in data.receivers]
+        # атрибуты события: время перехвата меняется, атрибуты сервера перехвата берутся из кэша фрагментов
+        capture_date, *server_attributes = wrappers.mandatory_attributes()
+        attributes = [capture_date, encoder.attributes_fragment(tuple(server_attributes))]
+        if data.name:
+            attributes.append(("event_name", data.name))
+        # потоки данных, если они заданы
+        evt_data = [make_event_data(data.data_file, data.data_attrs)] if data.data_file else []
+        # сообщения чата, если они заданы
+        messages = None
+        if data.messages:
+            messages = []
+            for msg in data.messages:
+                assert msg.sender_no < len(senders)
+                sender_id = senders[msg.sender_no][0]
+                sent_time = wrappers.get_current_datetime_tz() if msg.sent_time == "now" else msg.sent_time
+                text, data_id = self._split_message_text(evt_data, msg)
+                messages.append((sender_id, sent_time, text, data_id))
+        payload = encoder.encode_begin_event(
+            data.evt_class, data.service, attributes, senders, receivers,
+            evt_data, messages, self._creds
+        )
+        return encoder.EncodedEvent(payload, evt_data)
+
+    @classmethod
+    def make_chat_message(cls, evt, sender_id, msg):
+        """Формирует сообщение чата.
+        :param evt: событие, к которому добавляется сообщение
+        :param sender_id: идентификатор отправителя
+        :param msg: описание сообщения
+        """
+        text, data_id = cls._split_message_text(evt.evt_data, msg)
+        return wrappers.ChatMessage(sender_id, msg.sent_time, text, data_id)
+
+    @staticmethod
+    def _split_message_text(evt_data, msg):
+        """Возвращает текст сообщения и идентификатор потока с текстом.
+        Текст больше CHAT_INLINE_LIMIT байт передаётся отдельным потоком данных (mes_data_id),
+        чтобы не раздувать кадр BeginEvent. Поток добавляется в evt_data.
+        """
+        text = msg.text.encode('utf-8')
+        if len(text) <= settings.CHAT_INLINE_LIMIT:
+            return msg.text, None
+        data = EventDataFromString(text)
+        evt_data.append(data)
+        return '', data.data_id
+
     @staticmethod
     def make_event_attributes(evt, event_name):
         """Пример заполнения списка атрибутов события.
@@ -0,0 +1,142 @@
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from werkzeug.serving import make_server
+
+from config import logger
+
+# Minimal interval between restarts of the same worker, seconds
+RESTART_DELAY: float = 1.0
+
+
+def _make_listener(host: str, port: int, reuse_port: bool, backlog: int = 1024) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer:
+    """Serve WSGI app with N forked worker processes
+
+    The app is imported (preloaded) in the master process, GC heap is frozen
+    so that pages shared with workers are not copied by the collector.
+    Workers accept connections on a shared listener or, with reuse_port,
+    on their own SO_REUSEPORT sockets. Master restarts workers that exit.
+    """
+
+    def __init__(
+            self,
+            app,
+            host: str,
+            port: int,
+            workers: int,
+            reuse_port: bool = False,
+            on_worker_start: Optional[Callable[[int], None]] = None,
+            on_worker_exit: Optional[Callable[[int], None]] = None
+    ):
+        self.app = app
+        self.host: str = host
+        self.port: int = port
+        self.workers: int = workers or os.cpu_count() or 1
+        self.reuse_port: bool = reuse_port
+        self.on_worker_start = on_worker_start
+        self.on_worker_exit = on_worker_exit
+        self._children: Dict[int, int] = {}
+        self._started: Dict[int, float] = {}
+        self._listener: Optional[socket.socket] = None
+        self._stopping: bool = False
+
+    def serve(self) -> None:
+        if not self.reuse_port:
+            self._listener = _make_listener(self.host, self.port, reuse_port=False)
+        gc.collect()
+        gc.freeze()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.debug(f"Starting {self.workers} workers on [{self.host}:{self.port}]")
+        for number in range(self.workers):
+            self._spawn(number)
+        self._supervise()
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _supervise(self) -> None:
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            number: Optional[int] = self._children.pop(pid, None)
+            if number is None or self._stopping:
+                continue
+            logger.error(f"Worker {number} (pid {pid}) exited with status {status}, restarting")
+            delay: float = self._started[number] + RESTART_DELAY - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._spawn(number)
+        logger.debug("All workers stopped")
+
+    def _spawn(self, number: int) -> None:
+        self._started[number] = time.monotonic()
+        # обработчик мастера не должен сработать в дочернем процессе, пока тот не сбросил его
+        signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGTERM, signal.SIGINT))
+        try:
+            pid: int = os.fork()
+        except BaseException:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGTERM, signal.SIGINT))
+            raise
+        if pid:
+            self._children[pid] = number
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGTERM, signal.SIGINT))
+            return
+        code = 1
+        try:
+            self._reset_child()
+            self._run_worker(number)
+            code = 0
+        except BaseException as err:
+            logger.exception(f"Worker {number} failed: {err}")
+        finally:
+            os._exit(code)
+
+    def _reset_child(self) -> None:
+        """Drop state of the master in a forked worker before it starts"""
+
+        # до запуска сервера SIGTERM завершает процесс, Ctrl+C обрабатывает только мастер
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._children.clear()
+        self._started.clear()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGTERM, signal.SIGINT))
+
+    def _run_worker(self, number: int) -> None:
+        listener = self._listener or _make_listener(self.host, self.port, reuse_port=True)
+        if self.on_worker_start:
+            self.on_worker_start(number)
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=listener.fileno())
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        logger.debug(f"Worker {number} (pid {os.getpid()}) started")
+        try:
+            server.serve_forever()
+        finally:
+            if self.on_worker_exit:
+                self.on_worker_exit(number)
@@ -0,0 +1,238 @@
+"""Spool of built PushAPI events on disk
+
+A spool file starts with MAGIC and holds records: a header (type, payload
+length, crc32 of the payload) followed by the payload. An event is stored
+as an EVENT record with ttypes.Event in Thrift compact protocol, an
+optional META record (JSON of delivery details, not sent to PushAPI), a
+CHUNK record per piece of every data stream (data_id + bytes) and an END
+record.
+An event is complete only when its END record is read, so events cut by a
+crash or a failed stream are skipped on replay. A damaged record loses
+only its event: reading resumes at the next EVENT record whose checksum
+is valid.
+
+Replay does not run event creators again: the reader returns the decoded
+Event whose data streams are read back from the spool lazily, chunk by
+chunk, when the event is sent.
+"""
+import json
+import os
+import zlib
+from struct import Struct
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from thrift.protocol.TCompactProtocol import TCompactProtocolAccelerated
+from thrift.transport import TTransport
+
+from config import logger
+from pushapi import ttypes
+
+MAGIC: bytes = b'PUSHSPOOL1\n'
+RECORD_EVENT: int = 1
+RECORD_CHUNK: int = 2
+RECORD_END: int = 3
+RECORD_META: int = 4
+
+RECORD_TYPES: Tuple[int, ...] = (RECORD_EVENT, RECORD_CHUNK, RECORD_END, RECORD_META)
+
+_HEADER = Struct('!BII')
+_DATA_ID = Struct('!i')
+# Поиск следующего события после повреждённой записи читает файл блоками
+_RESYNC_BLOCK: int = 64 * 1024
+
+
+class SpoolError(ValueError):
+    """Spool file is damaged"""
+
+
+def encode_event(evt: ttypes.Event) -> bytes:
+    buffer = TTransport.TMemoryBuffer()
+    evt.write(TCompactProtocolAccelerated(buffer))
+    return buffer.getvalue()
+
+
+def decode_event(data: bytes) -> ttypes.Event:
+    evt = ttypes.Event()
+    evt.read(TCompactProtocolAccelerated(TTransport.TMemoryBuffer(data)))
+    return evt
+
+
+class SpoolWriter:
+    """Append events to a spool file"""
+
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path: str = path
+        self.chunk_size: int = chunk_size
+        self._stream: BinaryIO = open(path, 'ab')
+        if self._stream.tell() == 0:
+            self._stream.write(MAGIC)
+
+    def _write_record(self, record_type: int, *parts) -> None:
+        crc: int = 0
+        length: int = 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+            length += len(part)
+        self._stream.write(_HEADER.pack(record_type, length, crc))
+        for part in parts:
+            self._stream.write(part)
+
+    def write(self, evt: ttypes.Event, meta: Optional[dict] = None) -> int:
+        """Write event with its data streams, return offset of the event in the file"""
+
+        offset: int = self._stream.tell()
+        self._write_record(RECORD_EVENT, encode_event(evt))
+        if meta is not None:
+            self._write_record(RECORD_META, json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        for data in evt.evt_data or ():
+            data_id: bytes = _DATA_ID.pack(data.data_id)
+            for chunk in data.iter_chunks(self.chunk_size):
+                self._write_record(RECORD_CHUNK, data_id, chunk)
+        self._write_record(RECORD_END)
+        return offset
+
+    def flush(self) -> None:
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+    def fileno(self) -> int:
+        return self._stream.fileno()
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def __enter__(self) -> 'SpoolWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ChunkLocation(NamedTuple):
+    offset: int
+    length: int
+    crc: int
+
+
+class EventDataFromSpool(ttypes.EventData):
+    """Data stream of a spooled event, chunks are read from the spool when it is sent"""
+
+    def __init__(self, path: str, data_id: int, data_attributes, chunks: List[ChunkLocation]):
+        super().__init__(data_id, data_attributes)
+        self.path: str = path
+        self.chunks: List[ChunkLocation] = chunks
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[memoryview]:
+        with open(self.path, 'rb') as stream:
+            for location in self.chunks:
+                stream.seek(location.offset)
+                payload: bytes = stream.read(location.length)
+                if len(payload) != location.length or zlib.crc32(payload) != location.crc:
+                    raise SpoolError(f"{self.path}: damaged chunk at {location.offset}")
+                view = memoryview(payload)[_DATA_ID.size:]
+                for start in range(0, len(view), chunk_size):
+                    yield view[start:start + chunk_size]
+
+
+class SpooledEvent(NamedTuple):
+    offset: int
+    end: int
+    event: ttypes.Event
+    meta: Optional[dict] = None
+
+
+class SpoolReader:
+    """Read complete events of a spool file sequentially"""
+
+    def __init__(self, path: str, start: int = 0):
+        self.path: str = path
+        self.start: int = start
+
+    def __iter__(self) -> Iterator[SpooledEvent]:
+        with open(self.path, 'rb') as stream:
+            if stream.read(len(MAGIC)) != MAGIC:
+                raise SpoolError(f"{self.path}: not a spool file")
+            size: int = os.fstat(stream.fileno()).st_size
+            if self.start:
+                stream.seek(self.start)
+            pending: Optional[Tuple[int, ttypes.Event]] = None
+            meta: Optional[dict] = None
+            chunks: Dict[int, List[ChunkLocation]] = {}
+            while True:
+                offset: int = stream.tell()
+                header: bytes = stream.read(_HEADER.size)
+                if not header:
+                    break
+                record_type, length, crc = _HEADER.unpack(header) if len(header) == _HEADER.size else (0, 0, 0)
+                damaged: bool = record_type not in RECORD_TYPES or offset + _HEADER.size + length > size
+                if not damaged and record_type == RECORD_CHUNK:
+                    # содержимое потока не читается, запоминается только его место в файле
+                    prefix: bytes = stream.read(_DATA_ID.size)
+                    if length >= _DATA_ID.size and len(prefix) == _DATA_ID.size:
+                        data_id, = _DATA_ID.unpack(prefix)
+                        stream.seek(offset + _HEADER.size + length)
+                        chunks.setdefault(data_id, []).append(ChunkLocation(offset + _HEADER.size, length, crc))
+                        continue
+                    damaged = True
+                if not damaged:
+                    payload: bytes = stream.read(length)
+                    damaged = zlib.crc32(payload) != crc
+                if not damaged:
+                    try:
+                        if record_type == RECORD_EVENT:
+                            if pending is not None:
+                                logger.warning(f"{self.path}: incomplete event at {pending[0]} skipped")
+                            pending, meta, chunks = (offset, decode_event(payload)), None, {}
+                            continue
+                        if record_type == RECORD_META and pending is not None:
+                            meta = json.loads(payload)
+                            continue
+                    except Exception as err:
+                        logger.warning(f"{self.path}: record at {offset} is not decoded: {err!r}")
+                        damaged = True
+                if not damaged and record_type == RECORD_END and pending is not None:
+                    event_offset, evt = pending
+                    evt.evt_data = [
+                        EventDataFromSpool(self.path, data.data_id, data.data_attributes, chunks.get(data.data_id, []))
+                        for data in evt.evt_data or ()
+                    ]
+                    pending = None
+                    yield SpooledEvent(event_offset, stream.tell(), evt, meta)
+                    continue
+                # запись повреждена (или стоит вне события): теряется только её событие
+                if pending is not None:
+                    logger.warning(f"{self.path}: incomplete event at {pending[0]} skipped")
+                    pending = None
+                resumed: Optional[int] = self._resync(stream, offset + 1, size)
+                if resumed is None:
+                    logger.warning(f"{self.path}: damaged or truncated record at {offset}, no events after it")
+                    break
+                logger.error(f"{self.path}: damaged record at {offset} skipped, reading resumes at {resumed}")
+                stream.seek(resumed)
+            if pending is not None:
+                logger.warning(f"{self.path}: incomplete event at {pending[0]} skipped")
+
+    @staticmethod
+    def _resync(stream: BinaryIO, position: int, size: int) -> Optional[int]:
+        """Return offset of the next EVENT record with a valid checksum, None if there is none"""
+
+        marker: bytes = bytes((RECORD_EVENT,))
+        while position < size:
+            stream.seek(position)
+            block: bytes = stream.read(_RESYNC_BLOCK)
+            found: int = block.find(marker)
+            while found >= 0:
+                candidate: int = position + found
+                stream.seek(candidate)
+                header: bytes = stream.read(_HEADER.size)
+                if len(header) == _HEADER.size:
+                    _, length, crc = _HEADER.unpack(header)
+                    # пустое событие не бывает, а нули с нулевой суммой встречаются в любых данных
+                    if 0 < length <= size - candidate - _HEADER.size and zlib.crc32(stream.read(length)) == crc:
+                        return candidate
+                found = block.find(marker, found + 1)
+            position += len(block)
+        return None
@@ -0,0 +1,107 @@
+import hashlib
+import mimetypes
+import queue
+import threading
+from functools import lru_cache
+from pathlib import PurePosixPath
+from typing import BinaryIO, Dict, Iterable, Iterator
+
+_EOF = object()
+
+
+def _read_chunk(stream: BinaryIO, buffer: bytearray) -> int:
+    """Fill buffer from stream, return number of bytes read (0 on EOF)"""
+
+    view = memoryview(buffer)
+    size = 0
+    while size < len(buffer):
+        count = stream.readinto(view[size:])
+        if not count:
+            break
+        size += count
+    return size
+
+
+def _reader(stream: BinaryIO, free: queue.Queue, ready: queue.Queue, stop: threading.Event) -> None:
+    try:
+        while True:
+            buffer = free.get()
+            if stop.is_set():
+                return
+            size: int = _read_chunk(stream, buffer)
+            if not size:
+                break
+            ready.put((buffer, size))
+    except Exception as err:
+        ready.put(err)
+        return
+    ready.put(_EOF)
+
+
+def read_ahead(stream: BinaryIO, chunk_size: int, depth: int = 2) -> Iterator[memoryview]:
+    """Yield chunks of stream while a reader thread prefetches the next ones
+
+    Chunks are read with readinto() into a pool of depth + 1 reused buffers:
+    one is being sent by the consumer, the others are filled in background.
+    A yielded chunk is valid only until the next one is requested.
+    """
+
+    if depth < 1:
+        buffer = bytearray(chunk_size)
+        while True:
+            size: int = _read_chunk(stream, buffer)
+            if not size:
+                return
+            yield memoryview(buffer)[:size]
+
+    free: queue.Queue = queue.Queue()
+    ready: queue.Queue = queue.Queue()
+    for _ in range(depth + 1):
+        free.put(bytearray(chunk_size))
+    stop = threading.Event()
+    thread = threading.Thread(target=_reader, args=(stream, free, ready, stop), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is _EOF:
+                return
+            if isinstance(item, Exception):
+                raise item
+            buffer, size = item
+            try:
+                yield memoryview(buffer)[:size]
+            finally:
+                free.put(buffer)
+    finally:
+        stop.set()
+        free.put(bytearray(0))
+        thread.join()
+
+
+class StreamDigest:
+    """Content digests and byte count computed over chunks as they are sent"""
+
+    def __init__(self, algorithms: Iterable[str] = ('sha256',)):
+        self._hashes: dict = {name.strip(): hashlib.new(name.strip()) for name in algorithms if name.strip()}
+        self.size: int = 0
+
+    def update(self, chunk) -> None:
+        self.size += len(chunk)
+        for item in self._hashes.values():
+            item.update(chunk)
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {name: item.hexdigest() for name, item in self._hashes.items()}
+
+
+@lru_cache(maxsize=1024)
+def _guess_mimetype(extension: str) -> str:
+    mimetype, _ = mimetypes.guess_type(f'file{extension}', strict=False)
+    return mimetype or 'application/octet-stream'
+
+
+def get_mimetype(filename: str) -> str:
+    """Return mimetype by file extension, results are cached per extension"""
+
+    return _guess_mimetype(PurePosixPath(filename).suffix.lower())
@@ -0,0 +1,64 @@
+from typing import Dict, Optional
+
+from config import settings
+
+
+class Tenant:
+    """OwnCloud instance with its own PushAPI account"""
+
+    __slots__ = ('name', 'host', 'port', 'company_name', 'token', 'owncloud_host', 'weight')
+
+    def __init__(
+            self,
+            name: str,
+            company_name: str,
+            token: str,
+            owncloud_host: str,
+            host: Optional[str] = None,
+            port: Optional[int] = None,
+            weight: int = 1
+    ):
+        self.name: str = name
+        self.company_name: str = company_name
+        self.token: str = token
+        self.owncloud_host: str = owncloud_host
+        self.host: str = host or settings.HOST_DFL
+        self.port: int = int(port or settings.PORT_DFL)
+        self.weight: int = max(int(weight), 1)
+
+
+_tenants: Optional[Dict[str, Tenant]] = None
+
+
+def get_tenants() -> Dict[str, Tenant]:
+    """Return tenants from TENANTS setting, the default one is made of NAME_DFL, TOKEN_DFL and OWNCLOUD_HOST"""
+
+    global _tenants
+    if _tenants is None:
+        tenants: Dict[str, Tenant] = {
+            settings.TENANT_DEFAULT: Tenant(
+                settings.TENANT_DEFAULT, settings.NAME_DFL, settings.TOKEN_DFL, settings.OWNCLOUD_HOST
+            )
+        }
+        for name, options in settings.TENANTS.items():
+            tenants[name] = Tenant(name, **options.dict())
+        _tenants = tenants
+    return _tenants
+
+
+def get_tenant(name: Optional[str] = None) -> Tenant:
+    """Return tenant by name, KeyError is raised for unknown tenants"""
+
+    tenants: Dict[str, Tenant] = get_tenants()
+    if not name:
+        return tenants[settings.TENANT_DEFAULT]
+    if name not in tenants:
+        raise KeyError(f"unknown tenant [{name}]")
+    return tenants[name]
+
+
+def resolve_tenant(path_name: Optional[str], headers, data: dict) -> Tenant:
+    """Find tenant of the webhook by URL path, then by header, then by payload field"""
+
+    name: Optional[str] = path_name or headers.get(settings.TENANT_HEADER) or data.get(settings.TENANT_FIELD)
+    return get_tenant(name)
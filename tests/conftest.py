@@ -0,0 +1,25 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# модули приложения импортируются так же, как при запуске app/main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'app'))
+
+# обязательные настройки без значений по умолчанию
+for name, value in (
+        ('HOST_DFL', '127.0.0.1'), ('PORT_DFL', '9090'), ('NAME_DFL', 'test'), ('TOKEN_DFL', 'test'),
+        ('OWNCLOUD_HOST', 'http://127.0.0.1'),
+):
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture(scope='session')
+def shared_metrics():
+    """Shared metrics region: metrics of all modules are declared when main is imported"""
+
+    import main  # noqa: F401
+    import metrics
+
+    metrics.init(1)
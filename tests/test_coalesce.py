@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from coalesce import ShareCoalescer
+from event_creator import NodeShareEvent
+
+PATH: str = '/admin/files/Документы'
+
+
+def share(receiver: str, path: str = PATH) -> tuple:
+    creator = NodeShareEvent({
+        'request_type': 'node_shared', 'owner': 'admin', 'path': path, 'share_type': 0,
+        'share_with': receiver, 'permissions': 31, 'itemType': 'folder',
+    })
+    return creator, creator.create_event()
+
+
+@pytest.fixture
+def sent(shared_metrics):
+    return []
+
+
+def coalescer(sent: list, window: float = 60, delay: float = 0) -> ShareCoalescer:
+    def send(tenant, delivery_key, lane, event, metas):
+        time.sleep(delay)
+        sent.append((delivery_key, event.receivers, [meta['number'] for meta in metas]))
+
+    return ShareCoalescer(window, 100, 100, send)
+
+
+def add(coalescing: ShareCoalescer, receiver: str, number: int, path: str = PATH) -> None:
+    creator, event = share(receiver, path)
+    coalescing.add_share('default', creator, event, {'number': number}, path, 'high')
+
+
+def test_shares_of_a_path_are_sent_as_one_event(sent):
+    coalescing = coalescer(sent)
+    for number, receiver in enumerate(('user1', 'user2', 'user1', 'user3')):
+        add(coalescing, receiver, number)
+    coalescing.close()
+
+    assert sent == [(PATH, ('user1', 'user2', 'user3'), [0, 1, 2, 3])]
+
+
+def test_flush_sends_open_windows_of_the_key_before_returning(sent):
+    coalescing = coalescer(sent)
+    add(coalescing, 'user1', 0)
+    add(coalescing, 'user2', 1)
+    add(coalescing, 'user1', 2, path='/admin/files/other')
+
+    coalescing.flush('default', PATH)
+    sent.append('next event of the key')
+
+    assert sent == [(PATH, ('user1', 'user2'), [0, 1]), 'next event of the key']
+    coalescing.close()
+    assert sent[-1] == ('/admin/files/other', ('user1',), [2])
+
+
+def test_flush_waits_for_a_window_sent_by_the_expiry_thread(sent):
+    coalescing = coalescer(sent, window=0.05, delay=0.3)
+    add(coalescing, 'user1', 0)
+    # окно истекло и уже изъято потоком, но его событие ещё передаётся
+    deadline = time.monotonic() + 1
+    while len(coalescing) and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert not sent
+
+    coalescing.flush('default', PATH)
+    sent.append('next event of the key')
+    coalescing.close()
+
+    assert sent == [(PATH, ('user1',), [0]), 'next event of the key']
+
+
+def test_window_reopened_while_the_previous_one_is_sent_is_flushed_after_it(sent):
+    coalescing = coalescer(sent, window=0.05, delay=0.2)
+    add(coalescing, 'user1', 0)
+    while len(coalescing):
+        time.sleep(0.005)
+    add(coalescing, 'user2', 1)
+
+    coalescing.flush('default', PATH)
+    sent.append('next event of the key')
+    coalescing.close()
+
+    assert sent == [(PATH, ('user1',), [0]), (PATH, ('user2',), [1]), 'next event of the key']
@@ -0,0 +1,110 @@
+import queue
+import random
+import threading
+import time
+
+import pytest
+
+from config import settings
+from delivery import Delivery, DeliveryScheduler, LaneQueue, TenantQueue
+
+LANES = {'urgent': 3, 'routine': 1}
+
+
+def drain(lanes, count: int) -> list:
+    return [lanes.get() for _ in range(count)]
+
+
+def test_events_of_a_key_are_delivered_in_order(shared_metrics):
+    delivered: dict = {}
+    failed: set = set()
+    lock = threading.Lock()
+
+    def send(event, tenant, meta):
+        key, number = event
+        time.sleep(random.random() / 1000)
+        with lock:
+            # каждое третье событие доставляется только со второй попытки
+            if number % 3 == 0 and event not in failed:
+                failed.add(event)
+                raise ConnectionError('first attempt fails')
+            delivered.setdefault(key, []).append(number)
+        return number
+
+    # метрики полос объявлены при импорте, поэтому планировщик берёт полосы из настроек
+    scheduler = DeliveryScheduler(send, partitions=4, lanes=settings.DELIVERY_LANES, attempts=2, retry_delay=0.001)
+    for number in range(50):
+        for key in ('/a', '/b', '/c', '/d', '/e'):
+            scheduler.submit(key, (key, number), lane=random.choice(list(settings.DELIVERY_LANES)))
+    scheduler.close(10)
+
+    assert delivered == {key: list(range(50)) for key in ('/a', '/b', '/c', '/d', '/e')}
+
+
+def test_lanes_are_served_by_weight():
+    lanes = LaneQueue(LANES)
+    for number in range(8):
+        lanes.put(Delivery(f'/routine/{number}', number, lanes.lane('routine')))
+        lanes.put(Delivery(f'/urgent/{number}', number, lanes.lane('urgent')))
+
+    served = [lanes.names[delivery.lane] for delivery in drain(lanes, 8)]
+
+    assert served.count('urgent') == 6
+    assert served.count('routine') == 2
+    # нижняя полоса получает свою долю внутри каждого круга, а не после опустения верхней
+    assert 'routine' in served[:4]
+
+
+def test_urgent_event_pulls_older_events_of_its_key_along():
+    lanes = LaneQueue(LANES)
+    lanes.put(Delivery('/b', 'b1', lanes.lane('routine')))
+    lanes.put(Delivery('/a', 'a1', lanes.lane('routine')))
+    lanes.put(Delivery('/a', 'a2', lanes.lane('urgent')))
+
+    assert [delivery.event for delivery in drain(lanes, 3)] == ['a1', 'a2', 'b1']
+
+
+def test_old_event_of_a_low_lane_is_served_after_max_wait():
+    lanes = LaneQueue(LANES, max_wait=0.01)
+    lanes.put(Delivery('/routine', 'routine', lanes.lane('routine')))
+    for number in range(10):
+        lanes.put(Delivery(f'/urgent/{number}', 'urgent', lanes.lane('urgent')))
+    time.sleep(0.02)
+
+    assert lanes.get().event == 'routine'
+
+
+def test_tenants_are_served_by_deficit_round_robin():
+    tenants = TenantQueue(LANES, weights={'big': 3})
+    for number in range(9):
+        tenants.put(Delivery(f'/big/{number}', number, tenants.lane('routine'), tenant='big'))
+    for number in range(3):
+        tenants.put(Delivery(f'/small/{number}', number, tenants.lane('routine'), tenant='small'))
+
+    served = [delivery.tenant for delivery in drain(tenants, 12)]
+
+    assert served == ['big', 'big', 'big', 'small'] * 3
+
+
+def test_idle_tenant_does_not_save_up_deficit():
+    tenants = TenantQueue(LANES, weights={'big': 3})
+    tenants.put(Delivery('/small/0', 0, tenants.lane('routine'), tenant='small'))
+    assert tenants.get().tenant == 'small'
+    for number in range(4):
+        tenants.put(Delivery(f'/small/{number}', number, tenants.lane('routine'), tenant='small'))
+        tenants.put(Delivery(f'/big/{number}', number, tenants.lane('routine'), tenant='big'))
+
+    served = [delivery.tenant for delivery in drain(tenants, 5)]
+
+    assert served == ['small', 'big', 'big', 'big', 'small']
+
+
+@pytest.mark.parametrize('maxsize', [1, 2])
+def test_full_queue_of_a_tenant_does_not_block_others(maxsize):
+    tenants = TenantQueue(LANES, maxsize=maxsize)
+    for number in range(maxsize):
+        tenants.put(Delivery(f'/noisy/{number}', number, tenants.lane('routine'), tenant='noisy'))
+
+    with pytest.raises(queue.Full):
+        tenants.put(Delivery('/noisy/more', 'more', tenants.lane('routine'), tenant='noisy'), timeout=0.01)
+    tenants.put(Delivery('/quiet/0', 0, tenants.lane('routine'), tenant='quiet'), timeout=0.01)
@@ -0,0 +1,98 @@
+import pytest
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from thrift.transport.TTransport import TMemoryBuffer
+
+import pushapi.ttypes as pushapi
+from config import settings
+from event_creator import ChatMessage, EventDescription, FileTransmittingEvent, NodeShareEvent
+from pushapi import pushapi_wrappers as wrappers
+from pushapi.EventProcessor import BeginEvent_args
+from sender import TrafficMonitor
+
+NOW: str = '2024-03-01T12:00:00+03:00'
+
+
+def write(args: BeginEvent_args, protocol=TBinaryProtocol) -> bytes:
+    buffer = TMemoryBuffer()
+    args.write(protocol(buffer))
+    return buffer.getvalue()
+
+
+def read(payload: bytes) -> BeginEvent_args:
+    args = BeginEvent_args()
+    args.read(TBinaryProtocol(TMemoryBuffer(payload)))
+    return args
+
+
+def encode(event: EventDescription):
+    """Return event encoded directly and BeginEvent_args built from the same description"""
+
+    monitor = TrafficMonitor(event, '127.0.0.1', 9090, 'Company', 'token', client=object())
+    # идентификаторы элементов события выдаются по порядку, оба пути начинают с одного номера
+    wrappers.get_next_id.counter = 0
+    encoded = monitor.encode_event(event)
+    wrappers.get_next_id.counter = 0
+    args = BeginEvent_args(TrafficMonitor.make_event(event), monitor._creds)
+    return encoded, args
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    monkeypatch.setattr(wrappers, 'get_current_datetime_tz', lambda: NOW)
+
+
+def share_event() -> EventDescription:
+    creator = NodeShareEvent({
+        'request_type': 'node_shared', 'owner': 'admin', 'path': '/admin/files/Отчёт.docx',
+        'share_type': 0, 'share_with': 'user1', 'permissions': 31, 'itemType': 'file',
+        'expiration': None, 'passwordEnabled': True,
+    })
+    return creator.create_event()
+
+
+def file_event(tmp_path) -> EventDescription:
+    path = tmp_path / 'report.bin'
+    path.write_bytes(b'\x00\x01' * 1000)
+    return FileTransmittingEvent({
+        'request_type': 'file_transmitting', 'owner': 'admin', 'path': '/admin/files/report.bin',
+        'share_with': 'user1', 'uploaded_file': str(path),
+    }).create_event()
+
+
+def chat_event() -> EventDescription:
+    return EventDescription(
+        name='chat', evt_class=pushapi.EventClass.kChat, senders=('alice', 'bob'), receivers=('All',),
+        messages=(ChatMessage('привет'), ChatMessage('ответ', sender_no=1), ChatMessage('', sent_time=NOW)),
+    )
+
+
+@pytest.mark.parametrize('make', [chat_event, share_event, file_event], ids=['chat', 'share', 'file'])
+def test_matches_generated_write(make, tmp_path):
+    event: EventDescription = make(tmp_path) if make is file_event else make()
+    encoded, args = encode(event)
+    expected: bytes = write(args)
+    assert encoded.payload == expected
+    assert write(args, TBinaryProtocolAccelerated) == expected
+    decoded: BeginEvent_args = read(encoded.payload)
+    assert write(decoded) == expected
+    assert decoded.cred == args.cred
+    assert decoded.event.evt_attributes == args.event.evt_attributes
+    assert bool(encoded.evt_data) == bool(event.data_file)
+    assert [data.data_id for data in decoded.event.evt_data or ()] == [data.data_id for data in encoded.evt_data]
+
+
+def test_out_of_line_message(monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_INLINE_LIMIT', 16)
+    text: str = 'длинное сообщение ' * 10
+    event = EventDescription(
+        name='long', evt_class=pushapi.EventClass.kChat, senders=('alice',), receivers=('bob',),
+        messages=(ChatMessage(text), ChatMessage('short')),
+    )
+    encoded, args = encode(event)
+    assert encoded.payload == write(args)
+    decoded: BeginEvent_args = read(encoded.payload)
+    long_message, short_message = decoded.event.evt_messages
+    # длинный текст уходит отдельным потоком, на него ссылается сообщение
+    assert long_message.utf8_text == '' and long_message.mes_data_id == encoded.evt_data[0].data_id
+    assert short_message.utf8_text == 'short' and short_message.mes_data_id is None
+    assert b''.join(bytes(chunk) for chunk in encoded.evt_data[0].iter_chunks(64)) == text.encode('utf-8')
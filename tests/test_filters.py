@@ -0,0 +1,70 @@
+import pytest
+
+from filters import WebhookFilter
+
+
+def excluded(glob: str, path: str) -> bool:
+    """True if the path matches the glob of an exclude rule"""
+
+    webhook_filter = WebhookFilter({'rules': [{'action': 'exclude', 'paths': [glob]}]})
+    return not webhook_filter.accept({'request_type': 'file_created', 'owner': 'admin', 'path': path})
+
+
+@pytest.mark.parametrize('glob, path, matched', [
+    ('/*/thumbnails/**', '/admin/thumbnails/a.png', True),
+    ('/*/thumbnails/**', '/admin/thumbnails', True),
+    ('/*/thumbnails/**', '/admin/files/thumbnails/a.png', False),
+    ('/admin/*.tmp', '/admin/a.tmp', True),
+    ('/admin/*.tmp', '/admin/files/a.tmp', False),
+    ('**/*.part', '/admin/files/deep/video.mp4.part', True),
+    ('**/*.part', '/admin/files/video.mp4', False),
+    ('/admin/?.txt', '/admin/a.txt', True),
+    ('/admin/?.txt', '/admin/ab.txt', False),
+    ('/admin/?.txt', '/admin//.txt', False),
+    ('/admin/files_trashbin/**', '/admin/files_trashbin', True),
+    ('/admin/files_trashbin/**', '/admin/files_trashbin/x/y', True),
+    ('/admin/files_trashbin/**', '/admin/files_trashbin2/x', False),
+    ('/admin/cache/', '/admin/cache/x/y', True),
+    ('/admin/report.docx', '/admin/report.docx', True),
+    ('/admin/report.docx', '/admin/report.docx/x', False),
+    ('/admin/a+b (1).txt', '/admin/a+b (1).txt', True),
+    ('/admin/[ab].txt*', '/admin/[ab].txt', True),
+    ('/admin/[ab].txt*', '/admin/a.txt', False),
+])
+def test_path_globs(glob, path, matched):
+    assert excluded(glob, path) is matched
+
+
+def test_first_matching_rule_decides():
+    webhook_filter = WebhookFilter({
+        'default': 'exclude',
+        'rules': [
+            {'action': 'include', 'owners': ['admin'], 'paths': ['/admin/files/keep/**']},
+            {'action': 'exclude', 'paths': ['**/*.tmp']},
+            {'action': 'include', 'request_types': ['file_created']},
+        ],
+    })
+
+    def accept(request_type: str, path: str) -> bool:
+        return webhook_filter.accept({'request_type': request_type, 'owner': 'admin', 'path': path})
+
+    assert accept('file_created', '/admin/files/keep/a.tmp')
+    assert not accept('file_created', '/admin/files/a.tmp')
+    assert accept('file_created', '/admin/files/a.txt')
+    assert not accept('file_deleted', '/admin/files/a.txt')
+
+
+@pytest.mark.parametrize('size, accepted', [(100, False), ('100', False), (5000, True), ('big', True), (None, True)])
+def test_size_conditions(size, accepted):
+    webhook_filter = WebhookFilter({'rules': [{'action': 'exclude', 'max_size': 1024}]})
+
+    assert webhook_filter.accept({'request_type': 'node_downloaded', 'path': '/a', 'size': size}) is accepted
+
+
+def test_invalid_rules_fail_to_load():
+    with pytest.raises(ValueError):
+        WebhookFilter({'rules': [{'action': 'drop'}]})
+    with pytest.raises(ValueError):
+        WebhookFilter({'rules': [{'action': 'exclude', 'paths': ['relative/*']}]})
+    with pytest.raises(ValueError):
+        WebhookFilter({'rules': [{'action': 'exclude', 'max_size': '1k'}]})
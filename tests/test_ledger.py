@@ -0,0 +1,111 @@
+import contextlib
+import hashlib
+import itertools
+import json
+
+import pytest
+
+import main
+from ledger import Ledger, new_delivery_id
+from streams import StreamDigest
+
+
+class FakeMonitor:
+    """TrafficMonitor that counts sent events instead of talking to PushAPI"""
+
+    guids = itertools.count(1000)
+    sent: list = []
+
+    def __init__(self, event, **kwargs):
+        self.event = event
+        self.streams: dict = {}
+
+    def send_message(self):
+        self.sent.append(self.event)
+        digest = StreamDigest(['sha256'])
+        digest.update(b'content')
+        self.streams[7] = digest
+        return next(self.guids)
+
+
+class FakePool:
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        yield object()
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch, shared_metrics):
+    ledger = Ledger(str(tmp_path / 'ledger.db'), flush_interval=0.01)
+    FakeMonitor.sent = []
+    monkeypatch.setattr(main, '_ledger', lambda: ledger)
+    monkeypatch.setattr(main, 'get_pool', lambda tenant: FakePool())
+    monkeypatch.setattr(main, 'TrafficMonitor', FakeMonitor)
+    yield ledger
+    ledger.close()
+
+
+def webhook_meta(delivery_id: str = None) -> dict:
+    return {
+        'delivery_id': delivery_id or new_delivery_id(), 'fingerprint': 'fingerprint', 'tenant': 'default',
+        'request_type': 'file_created', 'path': '/admin/files/a.txt', 'owner': 'admin',
+    }
+
+
+def test_retry_of_an_accepted_event_is_not_sent_again(ledger, monkeypatch):
+    meta = webhook_meta()
+    guid = main.deliver('event', None, meta)
+    # повтор проверяется в памяти, запрос к журналу на пути вебхука не выполняется
+    monkeypatch.setattr(ledger, '_query', pytest.fail)
+
+    assert main.deliver('event', None, meta) == str(guid)
+    assert FakeMonitor.sent == ['event']
+
+
+def test_same_payload_arriving_again_is_sent(ledger):
+    main.deliver('event', None, webhook_meta())
+    main.deliver('event', None, webhook_meta())
+
+    assert FakeMonitor.sent == ['event', 'event']
+
+
+def test_replay_after_restart_is_recognized_by_the_ledger(ledger):
+    meta = webhook_meta()
+    guid = main.deliver('event', None, meta)
+    main._record_delivery(meta, 'delivered', guid=guid)
+    ledger.close()
+
+    restarted = Ledger(ledger.path)
+    try:
+        assert restarted.delivered_guid(meta['delivery_id'], lookup=False) is None
+        assert restarted.delivered_guid(meta['delivery_id']) == str(guid)
+    finally:
+        restarted.close()
+
+
+def test_stored_event_replayed_after_restart_is_not_sent_again(ledger, monkeypatch):
+    meta = webhook_meta()
+    ledger.record(status='delivered', guid=42, **meta)
+    ledger.close()
+    restarted = Ledger(ledger.path)
+    monkeypatch.setattr(main, '_ledger', lambda: restarted)
+    try:
+        assert main.deliver('event', None, meta, replayed=True) == '42'
+        assert FakeMonitor.sent == []
+    finally:
+        restarted.close()
+
+
+def test_stream_size_and_digests_are_recorded(ledger):
+    meta = webhook_meta()
+    guid = main.deliver('event', None, meta)
+    main._record_delivery(meta, 'delivered', guid=guid)
+    ledger.close()
+
+    restarted = Ledger(ledger.path)
+    try:
+        row, = restarted.find(delivery_id=meta['delivery_id'])
+    finally:
+        restarted.close()
+    assert row['size'] == len(b'content')
+    assert json.loads(row['digests']) == {'7': {'sha256': hashlib.sha256(b'content').hexdigest()}}
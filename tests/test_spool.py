@@ -0,0 +1,72 @@
+import pytest
+
+import pushapi.ttypes as pushapi
+from event_creator import EventDescription, FileTransmittingEvent
+from sender import TrafficMonitor
+from spool import _HEADER, SpoolReader, SpoolWriter, encode_event
+
+
+def chat_event(number: int):
+    description = EventDescription(
+        name=f'event {number}', evt_class=pushapi.EventClass.kChat, senders=('admin',), receivers=('user1',),
+    )
+    return TrafficMonitor.make_event(description)
+
+
+def write_segment(path, count: int) -> list:
+    """Write count events with their meta, return offsets of the events"""
+
+    with SpoolWriter(str(path)) as writer:
+        return [writer.write(chat_event(number), {'number': number}) for number in range(count)]
+
+
+def test_event_with_data_stream_round_trip(tmp_path):
+    content = bytes(range(256)) * 50
+    (tmp_path / 'report.bin').write_bytes(content)
+    description = FileTransmittingEvent({
+        'request_type': 'file_transmitting', 'owner': 'admin', 'path': '/admin/files/report.bin',
+        'share_with': 'user1', 'uploaded_file': str(tmp_path / 'report.bin'),
+    }).create_event()
+    evt = TrafficMonitor.make_event(description)
+    path = tmp_path / 'segment.spool'
+    with SpoolWriter(str(path), chunk_size=1000) as writer:
+        writer.write(evt, {'delivery_id': 'abc', 'path': 'Отчёт'})
+
+    spooled, = SpoolReader(str(path))
+
+    assert spooled.meta == {'delivery_id': 'abc', 'path': 'Отчёт'}
+    assert spooled.end == path.stat().st_size
+    # событие читается обратно теми же полями Thrift, потоки - из файла спула
+    assert encode_event(spooled.event) == encode_event(evt)
+    data, = spooled.event.evt_data
+    assert b''.join(data.iter_chunks(4096)) == content
+
+
+@pytest.mark.parametrize('damage', ['payload', 'length', 'type'])
+def test_damaged_record_loses_only_its_event(tmp_path, damage):
+    path = tmp_path / 'segment.spool'
+    offsets = write_segment(path, 5)
+    content = bytearray(path.read_bytes())
+    if damage == 'payload':
+        content[offsets[2] + _HEADER.size + 3] ^= 0xFF
+    elif damage == 'length':
+        content[offsets[2] + 1:offsets[2] + 5] = b'\xff\xff\xff\x00'
+    else:
+        content[offsets[2]] = 0x7F
+    path.write_bytes(bytes(content))
+
+    replayed = list(SpoolReader(str(path)))
+
+    assert [spooled.meta['number'] for spooled in replayed] == [0, 1, 3, 4]
+    assert [spooled.event.evt_attributes[-1].value for spooled in replayed] == [
+        'event 0', 'event 1', 'event 3', 'event 4',
+    ]
+    assert [spooled.offset for spooled in replayed] == [offsets[0], offsets[1], offsets[3], offsets[4]]
+
+
+def test_truncated_tail_is_skipped(tmp_path):
+    path = tmp_path / 'segment.spool'
+    offsets = write_segment(path, 3)
+    path.write_bytes(path.read_bytes()[:offsets[2] + _HEADER.size + 2])
+
+    assert [spooled.meta['number'] for spooled in SpoolReader(str(path))] == [0, 1]
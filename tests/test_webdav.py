@@ -0,0 +1,61 @@
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from owncloud import WebDAVClient
+from sender import EventDataFromWebDAV
+
+CONTENT: bytes = os.urandom(256 * 1024) + b'text compresses well\n' * 20000
+
+
+class Handler(BaseHTTPRequestHandler):
+    """WebDAV download compressed as web servers do when the client accepts gzip"""
+
+    def do_GET(self):
+        if self.path != '/remote.php/webdav/admin/files/report.bin':
+            self.send_error(404)
+            return
+        body: bytes = CONTENT
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and self.server.compress:
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[False, True], ids=['identity', 'gzip'])
+def owncloud(request):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.compress = request.param
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def read(data: EventDataFromWebDAV, chunk_size: int) -> list:
+    # чанк действителен только до запроса следующего, поэтому копируется
+    return [bytes(chunk) for chunk in data.iter_chunks(chunk_size)]
+
+
+@pytest.mark.parametrize('chunk_size', [64 * 1024, 1000003])
+def test_stream_matches_file(owncloud, chunk_size):
+    data = EventDataFromWebDAV('/admin/files/report.bin', client=WebDAVClient(owncloud))
+    chunks: list = read(data, chunk_size)
+    assert b''.join(chunks) == CONTENT
+    assert all(len(chunk) == chunk_size for chunk in chunks[:-1])
+
+
+def test_missing_file(owncloud):
+    data = EventDataFromWebDAV('/admin/files/missing.bin', client=WebDAVClient(owncloud))
+    with pytest.raises(Exception, match='404'):
+        read(data, 64 * 1024)